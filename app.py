@@ -1,16 +1,38 @@
 from fasthtml.common import *
 from pathlib import Path
-import cv2
 import os
 import shutil  # Add shutil import for recursive directory removal
-from scan import DocScanner
-from crop import crop_and_save
-from extract_digits_2 import extract_digits
-from pyimagesearch import transform
-import pytesseract
-from PIL import Image
+from pipeline import CardPipeline, init_worker, process_file
+from result_cache import ResultCache, cache_key
+import metrics
+from digit_classifier import DigitClassifier, DEFAULT_MODEL_PATH
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
 
-app, rt = fast_app()
+# Scanning and OCR are CPU bound and block, so they run in a pool of worker
+# processes, each with its own warmed-up pipeline. The pool is started by the
+# server rather than on import, since serve() imports this module again.
+executor = None
+
+def start_executor():
+    global executor
+    executor = ProcessPoolExecutor(SCAN_WORKERS, initializer=init_worker, initargs=(pipeline_kwargs,))
+    # Start every worker now so the first requests don't pay for their warm-up
+    for _ in range(SCAN_WORKERS):
+        executor.submit(os.getpid)
+
+def stop_executor():
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def restart_executor(broken):
+    # A worker that dies breaks the whole pool, so replace it, unless another
+    # upload that hit the same broken pool already has
+    if executor is broken:
+        broken.shutdown(wait=False)
+        start_executor()
+
+app, rt = fast_app(on_startup=[start_executor], on_shutdown=[stop_executor])
 
 # Create directories for uploads and results
 upload_dir = Path("uploads")
@@ -18,102 +40,109 @@ results_dir = Path("results")
 upload_dir.mkdir(exist_ok=True)
 results_dir.mkdir(exist_ok=True)
 
-def process_uploaded_image(input_path, output_dir):
+# SCAN_WORKERS uploads are processed at once by the worker pool; beyond
+# SCAN_QUEUE_LIMIT uploads in flight, new ones are turned away with a 503
+# instead of queueing behind everyone else.
+SCAN_WORKERS = int(os.environ.get("SCAN_WORKERS", os.cpu_count() or 1))
+SCAN_QUEUE_LIMIT = int(os.environ.get("SCAN_QUEUE_LIMIT", 2 * SCAN_WORKERS))
+
+# Use the trained digit classifier, if there is one, so Tesseract only reads
+# the digits it is unsure of
+DIGIT_MODEL_PATH = os.environ.get("DIGIT_MODEL_PATH", DEFAULT_MODEL_PATH)
+pipeline_kwargs = {}
+if os.path.exists(DIGIT_MODEL_PATH):
+    pipeline_kwargs['digit_classifier'] = DigitClassifier.load(DIGIT_MODEL_PATH)
+
+# Results are cached by the content of the upload and the pipeline settings, so
+# an image that was uploaded before is answered without being processed again
+result_cache = ResultCache(
+    os.environ.get("RESULT_CACHE_DIR", "cache"),
+    max_entries=int(os.environ.get("RESULT_CACHE_ENTRIES", 1000)),
+    max_bytes=int(os.environ.get("RESULT_CACHE_BYTES", 512 * 1024 * 1024)))
+# Building the pipeline here only reads its settings: the OCR backend it uses
+# is created in the worker processes, when they first read digits
+pipeline_params = CardPipeline(**pipeline_kwargs).params()
+
+in_flight = 0
+
+def cache_result(key, result):
+    # Store copies of the result files under names that don't depend on the upload
+    files = {'scanned': result['scanned'], 'cropped': result['cropped']}
+    for i, digit in enumerate(result['digits']):
+        files[f"digits/{i:03d}.png"] = digit
+    meta = {
+        'contour': result['contour'],
+        'digits': len(result['digits']),
+        'ocr_result': result['ocr_result'],
+        'individual_digits': result['individual_digits']
+    }
+    result_cache.put(key, meta, files)
+
+def restore_cached_result(key, output_dir, name, ext):
+    # Copy a cached result's files into output_dir under this upload's names, or
+    # return None if there is no cached result. An entry evicted while its files
+    # are being copied counts as a miss; processing the upload overwrites any
+    # files that were copied.
+    cached = result_cache.get(key)
+    if cached is None:
+        return None
+    meta, entry_dir = cached
+    
+    digits_dir = os.path.join(output_dir, 'digits')
+    os.makedirs(digits_dir, exist_ok=True)
+    result = dict(meta)
+    result['scanned'] = os.path.join(output_dir, f"{name}_scanned{ext}")
+    result['cropped'] = os.path.join(output_dir, f"{name}_scanned_crop_0{ext}")
+    result['digits'] = [os.path.join(digits_dir, f"{name}_scanned_crop_0_{i:03d}.png") for i in range(meta['digits'])]
+    try:
+        shutil.copyfile(os.path.join(entry_dir, 'scanned'), result['scanned'])
+        shutil.copyfile(os.path.join(entry_dir, 'cropped'), result['cropped'])
+        for i, digit_path in enumerate(result['digits']):
+            shutil.copyfile(os.path.join(entry_dir, 'digits', f"{i:03d}.png"), digit_path)
+    except FileNotFoundError:
+        result_cache.record_hit(False)
+        return None
+    result_cache.record_hit(True)
+    return result
+
+async def process_uploaded_image(input_path, output_dir, content):
     # Get base filename without extension
     basename = os.path.basename(input_path)
     name, ext = os.path.splitext(basename)
     
-    # Step 1: Scan the document to get rectangular image
-    scanner = DocScanner(interactive=False)
-    scanned_path = output_dir / f"{name}_scanned{ext}"
-    
-    # Load and process the image
-    image = cv2.imread(str(input_path))
-    assert image is not None, f"Failed to load image: {input_path}"
+    # The extension decides the format the results are encoded in, so it is
+    # part of the key
+    key = cache_key(content, dict(pipeline_params, ext=ext.lower()))
     
-    # Get the contour and transform
-    ratio = image.shape[0] / 500.0
-    rescaled_image = cv2.resize(image, (int(image.shape[1] / ratio), 500))
-    screenCnt = scanner.get_contour(rescaled_image)
-    warped = transform.four_point_transform(image, screenCnt * ratio)
-    
-    # Apply sharpening
-    sharpen = cv2.GaussianBlur(warped, (0, 0), 3)
-    sharpen = cv2.addWeighted(warped, 1.5, sharpen, -0.5, 0)
-    cv2.imwrite(str(scanned_path), sharpen)
-    
-    # Step 2: Crop the region with digits
-    crop_params = [(0.75, 0.14, 0.4, 0)]
-    crop_and_save(str(scanned_path), crop_params, str(output_dir))
-    
-    # Step 3: Extract digits from the cropped region
-    cropped_path = output_dir / f"{name}_scanned_crop_0{ext}"
-    digits_dir = output_dir / 'digits'
-    digits_dir.mkdir(exist_ok=True)
-    
-    # Extract digits with error handling
-    try:
-        extract_digits(str(cropped_path), str(digits_dir))
-        digit_count = len([f for f in os.listdir(digits_dir) if f.endswith('.png')])
-        print(f"Extracted {digit_count} digits")
-    except Exception as e:
-        print(f"Error during digit extraction: {str(e)}")
-        raise
-    
-    # Verify digits were extracted
-    digit_files = sorted([f for f in digits_dir.glob('*.png')])
-    print(f"Found {len(digit_files)} digit files: {[f.name for f in digit_files]}")
-    
-    # Perform Tesseract OCR on the cropped region
-    try:
-        # Convert to PIL Image for Tesseract
-        cropped_img = Image.open(str(cropped_path))
-        # Configure Tesseract to use Arabic trained data and only look for digits
-        custom_config = r'--oem 3 --psm 6 -l ara_number outputbase digits'
-        ocr_result = pytesseract.image_to_string(cropped_img, config=custom_config).strip()
-    except Exception as e:
-        print(f"Error during OCR: {str(e)}")
-        ocr_result = "OCR Failed"
-    
-    # Perform individual digit recognition
-    individual_digits = []
-    
-    # First pass: calculate areas and find maximum
-    digit_areas = []
-    for digit_file in digit_files:
-        digit_img = cv2.imread(str(digit_file), cv2.IMREAD_GRAYSCALE)
-        # Count non-zero pixels as the digit area
-        area = cv2.countNonZero(digit_img)
-        digit_areas.append(area)
-    
-    max_area = max(digit_areas) if digit_areas else 0
-    area_threshold = max_area * 0.30
-    print(digit_areas)
-    print(area_threshold)
-    # Second pass: recognize digits
-    for i, digit_file in enumerate(digit_files):
-        try:
-            # If area is less than threshold, classify as zero
-            if digit_areas[i] < area_threshold:
-                individual_digits.append('0')
-                continue
-                
-            # Otherwise perform OCR
-            digit_img = Image.open(str(digit_file))
-            digit_config = r'--oem 3 --psm 10 -l ara_number outputbase digits'  # PSM 10 for single character
-            digit_result = pytesseract.image_to_string(digit_img, config=digit_config).strip()
-            individual_digits.append(digit_result)
-        except Exception as e:
-            print(f"Error during individual digit OCR: {str(e)}")
-            individual_digits.append("?")
+    # Serve a repeated upload from the cache. Otherwise scan, crop, extract and
+    # read the digits in a worker process, saving the images that are displayed.
+    # The event loop is free to serve other requests in the meantime, and file
+    # copies to and from the cache run in a thread for the same reason
+    loop = asyncio.get_running_loop()
+    with metrics.timed("request"):
+        result = await loop.run_in_executor(None, restore_cached_result, key, str(output_dir), name, ext)
+        if result is None:
+            pool = executor
+            try:
+                result = await loop.run_in_executor(pool, process_file, input_path, output_dir)
+            except BrokenProcessPool:
+                restart_executor(pool)
+                raise
+            # add the stage timings the worker recorded to this process's
+            metrics.get_metrics().merge(result['metrics'])
+            # the upload has been processed, so failing to cache it is not an error
+            try:
+                await loop.run_in_executor(None, cache_result, key, result)
+            except Exception as e:
+                print(f"Failed to cache the result of {basename}: {str(e)}")
     
     return {
         'original': f"uploads/{basename}",
         'scanned': f"results/{name}/{name}_scanned{ext}",
         'cropped': f"results/{name}/{name}_scanned_crop_0{ext}",
-        'digits': [f"results/{name}/digits/{f.name}" for f in digit_files],
-        'ocr_result': ocr_result,
-        'individual_digits': individual_digits
+        'digits': [f"results/{name}/digits/{os.path.basename(f)}" for f in result['digits']],
+        'ocr_result': result['ocr_result'],
+        'individual_digits': result['individual_digits']
     }
 
 @rt('/')
@@ -156,30 +185,73 @@ def display_results(paths):
 
 @rt
 async def upload(file: UploadFile):
-    # Save uploaded file
-    filename = file.filename
-    file_path = upload_dir / filename
+    global in_flight
     
-    # Create unique results directory for this upload
-    name = os.path.splitext(filename)[0]
-    output_dir = results_dir / name
-    if output_dir.exists():
-        shutil.rmtree(output_dir)  # Recursively remove directory and contents
-    output_dir.mkdir(exist_ok=True)
+    # Turn the upload away if too many are already being processed. The count
+    # is taken before the first await so concurrent uploads can't all slip in
+    if in_flight >= SCAN_QUEUE_LIMIT:
+        return HTMLResponse(to_xml(Article(
+            H3("Server Busy", cls="error"),
+            P("Too many documents are being processed. Please try again shortly.")
+        )), status_code=503, headers={"Retry-After": "5"})
+    in_flight += 1
     
-    # Save the uploaded file
-    content = await file.read()
-    file_path.write_bytes(content)
-    
-    # Process the image
     try:
-        result_paths = process_uploaded_image(file_path, output_dir)
+        # Save uploaded file
+        filename = file.filename
+        file_path = upload_dir / filename
+        
+        # Create unique results directory for this upload
+        name = os.path.splitext(filename)[0]
+        output_dir = results_dir / name
+        if output_dir.exists():
+            shutil.rmtree(output_dir)  # Recursively remove directory and contents
+        output_dir.mkdir(exist_ok=True)
+        
+        # Save the uploaded file
+        content = await file.read()
+        file_path.write_bytes(content)
+        
+        # Process the image
+        result_paths = await process_uploaded_image(file_path, output_dir, content)
         return display_results(result_paths)
+    except BrokenProcessPool:
+        # the pool has been replaced, so the upload can simply be tried again
+        return Article(
+            H3("Error Processing Image", cls="error"),
+            P("A worker process crashed while processing the image. Please try again.")
+        )
     except Exception as e:
         return Article(
             H3("Error Processing Image", cls="error"),
             P(str(e))
         )
+    finally:
+        in_flight -= 1
+
+@rt('/cache_stats')
+def get():
+    return result_cache.stats()
+
+@rt('/metrics')
+def get():
+    # Stage latency histograms and counts in the Prometheus text format, along
+    # with the result cache counters and the number of uploads in flight
+    stats = result_cache.stats()
+    lines = [
+        "# TYPE docscanner_cache_hits_total counter",
+        f"docscanner_cache_hits_total {stats['hits']}",
+        "# TYPE docscanner_cache_misses_total counter",
+        f"docscanner_cache_misses_total {stats['misses']}",
+        "# TYPE docscanner_cache_entries gauge",
+        f"docscanner_cache_entries {stats['entries']}",
+        "# TYPE docscanner_cache_bytes gauge",
+        f"docscanner_cache_bytes {stats['bytes']}",
+        "# TYPE docscanner_uploads_in_flight gauge",
+        f"docscanner_uploads_in_flight {in_flight}",
+    ]
+    return Response(metrics.get_metrics().to_prometheus() + "\n".join(lines) + "\n",
+        media_type="text/plain; version=0.0.4")
 
 # Serve static files from uploads and results directories
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
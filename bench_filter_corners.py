@@ -0,0 +1,48 @@
+# USAGE:
+# python bench_filter_corners.py [--repeat N]
+# Micro-benchmark comparing DocScanner.filter_corners against the original
+# pairwise implementation on random corner sets of 50, 500 and 5000 points.
+
+from scipy.spatial import distance as dist
+from scan import DocScanner
+import numpy as np
+
+import argparse
+import timeit
+
+def pairwise_filter_corners(corners, min_dist=20):
+    """The original O(n^2) filter_corners, kept as the reference implementation"""
+    def predicate(representatives, corner):
+        return all(dist.euclidean(representative, corner) >= min_dist
+                   for representative in representatives)
+
+    filtered_corners = []
+    for c in corners:
+        if predicate(filtered_corners, c):
+            filtered_corners.append(c)
+    return filtered_corners
+
+def random_corners(n, width=700, height=500, seed=0):
+    """Returns n corners spread across a rescaled image, as get_corners produces them"""
+    rng = np.random.default_rng(seed)
+    xs = rng.integers(0, width, n)
+    ys = rng.integers(0, height, n)
+    return list(zip(xs.tolist(), ys.tolist()))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=3,
+        help = "Number of timed runs per size; the fastest is reported")
+    args = vars(ap.parse_args())
+
+    scanner = DocScanner()
+
+    print("%8s %8s %14s %14s %9s" % ("corners", "kept", "pairwise (ms)", "grid (ms)", "speedup"))
+    for n in (50, 500, 5000):
+        corners = random_corners(n)
+        expected = pairwise_filter_corners(corners)
+        assert scanner.filter_corners(corners) == expected
+
+        old = min(timeit.repeat(lambda: pairwise_filter_corners(corners), number=1, repeat=args["repeat"]))
+        new = min(timeit.repeat(lambda: scanner.filter_corners(corners), number=1, repeat=args["repeat"]))
+        print("%8d %8d %14.2f %14.2f %8.1fx" % (n, len(expected), old * 1000, new * 1000, old / new))
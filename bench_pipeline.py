@@ -0,0 +1,163 @@
+# USAGE:
+# python bench_pipeline.py [--output bench.json] [--megapixels 1 4 12 24] [--repeat N] [--stages ...] [--ocr]
+# Benchmarks DocScanner.get_contour, four_point_transform, extract_digits and the
+# full CardPipeline over sample_images/ and synthetic cards of several sizes, and
+# saves p50/p95 latency, images/sec and peak RSS per stage to a JSON file.
+# To compare two commits, run it on each and diff the JSON files, e.g.
+# python bench_pipeline.py --output before.json
+
+from scan import DocScanner
+from crop import warp_and_crop
+from extract_digits_2 import segment_digits
+from pipeline import CardPipeline, DIGITS_CROP_PARAMS
+from pyimagesearch import transform
+from synthetic import render_document
+import numpy as np
+import cv2
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+STAGES = ("get_contour", "four_point_transform", "extract_digits", "pipeline")
+SAMPLE_DIR = "sample_images"
+RESCALED_HEIGHT = 500.0
+
+def load_group(group):
+    """
+    Returns the list of BGR images of a benchmark group: "sample_images", or
+    "synthetic_<N>mp" for synthetic cards of N megapixels. Synthetic cards use
+    fixed seeds, so every run sees the same images.
+    """
+    if group == SAMPLE_DIR:
+        names = sorted(os.listdir(SAMPLE_DIR))
+        return [cv2.imread(os.path.join(SAMPLE_DIR, name)) for name in names]
+    megapixels = float(group[len("synthetic_"):-len("mp")])
+    return [render_document(megapixels, seed=seed)[0] for seed in range(3)]
+
+def prepare(stage, image, scanner):
+    """
+    Returns a function running stage on image, with the work of the earlier stages
+    (rescaling, detection, warping) already done so only the stage itself is timed.
+    """
+    ratio = image.shape[0] / RESCALED_HEIGHT
+    rescaled_image = cv2.resize(image, (int(image.shape[1] / ratio), int(RESCALED_HEIGHT)))
+    if stage == "get_contour":
+        return lambda: scanner.get_contour(rescaled_image)
+
+    corners = scanner.get_contour(rescaled_image) * ratio
+    if stage == "four_point_transform":
+        return lambda: transform.four_point_transform(image, corners)
+    if stage == "extract_digits":
+        cropped = warp_and_crop(image, corners, [DIGITS_CROP_PARAMS])[0]
+        return lambda: segment_digits(cropped)
+    raise ValueError("Unknown stage: " + stage)
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+def run_stage(stage, group, repeat, run_ocr):
+    """
+    Times stage on every image of group, repeat times each after one untimed
+    warm-up run, and returns a dict of the results. Meant to run in a fresh
+    process, so the peak RSS it reports belongs to this stage alone.
+    """
+    # the stages print progress, which would drown out the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        images = load_group(group)
+        if stage == "pipeline":
+            pipeline = CardPipeline(run_ocr=run_ocr)
+            runs = [lambda image=image: pipeline.process(image) for image in images]
+        else:
+            scanner = DocScanner()
+            runs = [prepare(stage, image, scanner) for image in images]
+        rss_before = peak_rss_mb()
+
+        latencies = []
+        for run in runs:
+            run()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies)
+    megapixels = [image.shape[0] * image.shape[1] / 1e6 for image in images]
+    return {
+        'stage': stage,
+        'group': group,
+        'images': len(images),
+        'megapixels': round(float(np.mean(megapixels)), 2),
+        'runs': len(latencies),
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 3),
+        'images_per_sec': round(float(len(latencies) / latencies.sum()), 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'stage_rss_mb': round(peak_rss_mb() - rss_before, 1)
+    }
+
+def environment():
+    """Returns what the results depend on besides the code: versions and hardware"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'opencv_threads': cv2.getNumThreads()
+    }
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--output", default="bench.json",
+        help = "JSON file the results are written to")
+    ap.add_argument("--megapixels", type=float, nargs="*", default=[1, 4, 12, 24],
+        help = "Sizes of the synthetic cards, in megapixels")
+    ap.add_argument("--repeat", type=int, default=5,
+        help = "Number of timed runs per image")
+    ap.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES),
+        help = "Stages to benchmark")
+    ap.add_argument("--ocr", action='store_true',
+        help = "Include OCR in the full pipeline stage")
+    args = vars(ap.parse_args())
+
+    groups = [SAMPLE_DIR] + ["synthetic_%gmp" % mp for mp in args["megapixels"]]
+
+    # every stage and group runs in a fresh process so their memory use and
+    # caches don't leak into each other's numbers
+    context = multiprocessing.get_context("spawn")
+    results = []
+    print("%-22s %-16s %7s %10s %10s %10s %10s %10s" % ("stage", "group", "runs",
+        "p50(ms)", "p95(ms)", "images/s", "peak(MB)", "stage(MB)"))
+    for stage in args["stages"]:
+        for group in groups:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_stage, (stage, group, args["repeat"], args["ocr"]))
+            results.append(result)
+            print("%-22s %-16s %7d %10.2f %10.2f %10.2f %10.1f %10.1f" % (stage, group,
+                result['runs'], result['p50_ms'], result['p95_ms'], result['images_per_sec'],
+                result['peak_rss_mb'], result['stage_rss_mb']))
+
+    with open(args["output"], "w") as f:
+        json.dump({
+            'environment': environment(),
+            'settings': {'repeat': args["repeat"], 'ocr': args["ocr"]},
+            'results': results
+        }, f, indent=2)
+    print("Saved results to " + args["output"])
@@ -1,5 +1,85 @@
 import cv2
+import math
 import os
+import metrics
+from pyimagesearch import imutils
+from pyimagesearch import transform
+
+# Number of output rows warp_strips warps and sharpens at a time
+STRIP_HEIGHT = 256
+
+
+def crop_rect(height, width, crop_params):
+    # Calculate the pixel values based on the proportions
+    top, bottom, left, right = crop_params
+    top_px = int(top * height)
+    bottom_px = int(height - (bottom * height))
+    left_px = int(left * width)
+    right_px = int(width - (right * width))
+    return top_px, bottom_px, left_px, right_px
+
+
+def crop_image(image, crop_params):
+    # Crop a region out of an image that is already in memory, raising a
+    # ValueError for a region with no pixels as warp_and_crop does
+    height, width = image.shape[:2]
+    top_px, bottom_px, left_px, right_px = crop_rect(height, width, crop_params)
+    if right_px <= left_px or bottom_px <= top_px:
+        raise ValueError(f"Crop {crop_params} of the {width}x{height} document is empty")
+    return image[top_px:bottom_px, left_px:right_px]
+
+
+def warp_and_crop(image, pts, crop_params_list, sharpen=True, sigma=3):
+    # Warp and crop each region of the document straight from the source image,
+    # giving the same crops as four_point_transform + sharpen + crop_and_save
+    # without warping, sharpening or saving the whole document. A region with
+    # no pixels raises a ValueError rather than giving an image that can't be
+    # saved
+    _, width, height = transform.get_four_point_transform(pts)
+
+    # The blur used to sharpen reaches this far, so each region is warped with
+    # a halo around it that is dropped once it has been sharpened
+    halo = int(math.ceil(4 * sigma)) if sharpen else 0
+
+    crops = []
+    for crop_params in crop_params_list:
+        top_px, bottom_px, left_px, right_px = crop_rect(height, width, crop_params)
+
+        # Clamp the halo to the full warped image, so regions touching its edge
+        # see the same border as they would if the whole image were sharpened
+        if right_px <= left_px or bottom_px <= top_px:
+            raise ValueError(f"Crop {crop_params} of the {width}x{height} document is empty")
+        x0, y0 = max(left_px - halo, 0), max(top_px - halo, 0)
+        x1, y1 = min(right_px + halo, width), min(bottom_px + halo, height)
+
+        with metrics.timed("warp"):
+            region = transform.four_point_transform_region(image, pts, x0, y0, x1 - x0, y1 - y0)
+        if sharpen:
+            with metrics.timed("sharpen"):
+                region = imutils.sharpen(region, sigma)
+        crops.append(region[top_px - y0:bottom_px - y0, left_px - x0:right_px - x0])
+
+    return crops
+
+
+def warp_strips(image, pts, strip_height=STRIP_HEIGHT, sharpen=True, sigma=3):
+    # Warp and sharpen the document a horizontal strip at a time, yielding
+    # (y, strip) from top to bottom, so only a strip of the output is held in
+    # memory at once however large the document is. Each strip is warped with
+    # a halo of the rows the blur reaches above and below it, giving the same
+    # rows as four_point_transform + sharpen on the whole document
+    _, width, height = transform.get_four_point_transform(pts)
+    halo = int(math.ceil(4 * sigma)) if sharpen else 0
+
+    for top in range(0, height, strip_height):
+        bottom = min(top + strip_height, height)
+        y0, y1 = max(top - halo, 0), min(bottom + halo, height)
+        with metrics.timed("warp"):
+            region = transform.four_point_transform_region(image, pts, 0, y0, width, y1 - y0)
+        if sharpen:
+            with metrics.timed("sharpen"):
+                region = imutils.sharpen(region, sigma)
+        yield top, region[top - y0:bottom - y0]
 
 
 def crop_and_save(image_path, crop_params_list, output_dir="output"):
@@ -14,12 +94,8 @@ def crop_and_save(image_path, crop_params_list, output_dir="output"):
         os.makedirs(output_dir)
 
     # Iterate through the crop parameters and process each cropped section
-    for idx, (top, bottom, left, right) in enumerate(crop_params_list):
-        # Calculate the pixel values based on the proportions
-        top_px = int(top * height)
-        bottom_px = int(height - (bottom * height))
-        left_px = int(left * width)
-        right_px = int(width - (right * width))
+    for idx, crop_params in enumerate(crop_params_list):
+        top_px, bottom_px, left_px, right_px = crop_rect(height, width, crop_params)
 
         # Crop the image
         cropped_image = image[top_px:bottom_px, left_px:right_px]
@@ -0,0 +1,129 @@
+# USAGE:
+# python digit_classifier.py <LABELED_DIGITS_DIR> [--output digit_model.npz]
+# Trains the digit classifier from digit images produced by extract_digits_2.py,
+# sorted into one sub-directory per label, e.g. labeled_digits/3/card_0_003.png
+
+import cv2
+import numpy as np
+
+import os
+
+# Side of the square each digit is resized to before being compared
+SAMPLE_SIZE = 16
+
+# Number of nearest training samples that vote on each digit's label
+K = 5
+
+# Digits whose vote share is below this are left for Tesseract to read
+MIN_CONFIDENCE = 0.8
+
+# Where the app looks for a trained model
+DEFAULT_MODEL_PATH = "digit_model.npz"
+
+
+def digit_features(digits, size=SAMPLE_SIZE):
+    """
+    Returns an (N, size * size) float32 array with one row per digit image: the digit
+    resized to size x size and normalised to unit length, so that the dot product of
+    two rows is their cosine similarity.
+    """
+    features = np.zeros((len(digits), size * size), dtype=np.float32)
+    for i, digit in enumerate(digits):
+        if digit.ndim == 3:
+            digit = cv2.cvtColor(digit, cv2.COLOR_BGR2GRAY)
+        features[i] = cv2.resize(digit, (size, size), interpolation=cv2.INTER_AREA).ravel()
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.maximum(norms, 1e-6)
+
+
+class DigitClassifier(object):
+    """
+    A k-nearest-neighbour classifier for the thresholded square digit images made by
+    extract_digits_2. The training samples are kept as one matrix, so a whole card's
+    digits are classified with a single matrix product.
+    """
+
+    def __init__(self, samples, labels, k=K, min_confidence=MIN_CONFIDENCE):
+        """
+        Args:
+            samples (numpy array): (M, SAMPLE_SIZE * SAMPLE_SIZE) features of the
+                training digits, as returned by digit_features().
+            labels (numpy array): (M,) label of each training digit.
+            k (int): Number of nearest samples that vote on a label. Defaults to K.
+            min_confidence (float): Labels with a lower confidence should be checked
+                by another recogniser. Defaults to MIN_CONFIDENCE.
+        """
+        self.samples = np.asarray(samples, dtype=np.float32)
+        self.labels = np.asarray(labels).astype(str)
+        self.k = min(k, len(self.labels))
+        self.min_confidence = min_confidence
+        self.classes, self.label_ids = np.unique(self.labels, return_inverse=True)
+
+    @classmethod
+    def fit(cls, digits, labels, k=K):
+        """Returns a classifier trained on a list of digit images and their labels"""
+        return cls(digit_features(digits), labels, k)
+
+    @classmethod
+    def load(cls, path):
+        """Returns a classifier loaded from a file written by save()"""
+        with np.load(path) as model:
+            return cls(model['samples'], model['labels'], int(model['k']))
+
+    def save(self, path):
+        """Writes the training samples and labels to a compressed NumPy file"""
+        np.savez_compressed(path, samples=self.samples, labels=self.labels, k=self.k)
+
+    def classify(self, digits):
+        """
+        Returns (labels, confidences) for a list of digit images. The confidence of a
+        label is the share of the k nearest training samples that voted for it.
+        """
+        if len(digits) == 0:
+            return np.array([], dtype=str), np.array([], dtype=np.float32)
+
+        similarity = digit_features(digits).dot(self.samples.T)
+        nearest = np.argpartition(-similarity, self.k - 1, axis=1)[:, :self.k]
+
+        # count the votes for every class in one go
+        votes = np.zeros((len(digits), len(self.classes)), dtype=np.int32)
+        np.add.at(votes, (np.arange(len(digits))[:, np.newaxis], self.label_ids[nearest]), 1)
+
+        best = votes.argmax(axis=1)
+        confidences = votes[np.arange(len(digits)), best] / float(self.k)
+        return self.classes[best], confidences
+
+
+def load_labeled_digits(directory):
+    """
+    Returns (digits, labels) for the digit images in directory, which holds one
+    sub-directory of images per label.
+    """
+    digits = []
+    labels = []
+    for label in sorted(os.listdir(directory)):
+        label_dir = os.path.join(directory, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for filename in sorted(os.listdir(label_dir)):
+            digit = cv2.imread(os.path.join(label_dir, filename), cv2.IMREAD_GRAYSCALE)
+            if digit is not None:
+                digits.append(digit)
+                labels.append(label)
+    return digits, labels
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Train the digit classifier')
+    parser.add_argument('labeled_dir', help='Directory with one sub-directory of digit images per label')
+    parser.add_argument('--output', default=DEFAULT_MODEL_PATH, help='Where to save the trained model')
+    args = parser.parse_args()
+
+    digits, labels = load_labeled_digits(args.labeled_dir)
+    assert digits, f"No digit images found in {args.labeled_dir}"
+
+    classifier = DigitClassifier.fit(digits, labels)
+    classifier.save(args.output)
+    print(f"Trained on {len(digits)} digits of {len(classifier.classes)} classes, saved to {args.output}")
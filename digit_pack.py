@@ -0,0 +1,175 @@
+import numpy as np
+
+import json
+import os
+import struct
+
+# Start of every packed digits file: magic and format version
+FILE_MAGIC = b"DGPK"
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct("<4sH")
+
+# Start of each card's record: marker, length of the card name and number of digits
+RECORD_MARKER = b"CARD"
+RECORD_HEADER = struct.Struct("<4sHH")
+
+# Bounding box of each digit in the digit region: x, y, width, height
+BOX_DTYPE = np.dtype("<u2")
+
+# Suffix of the index written next to a shard
+INDEX_SUFFIX = ".index.jsonl"
+
+
+def pack_card(name, digits, boxes):
+    """
+    Returns the record of one card as bytes: the header, the (x, y, w, h) box of
+    each digit, then each digit's mask packed to one bit per pixel. digits are
+    single channel binary masks, such as those returned by segment_digits().
+    """
+    if len(digits) != len(boxes):
+        raise ValueError("Expected one box per digit")
+    boxes = np.asarray(boxes, dtype=BOX_DTYPE).reshape(-1, 4)
+    name = name.encode("utf-8")
+    chunks = [RECORD_HEADER.pack(RECORD_MARKER, len(name), len(digits)), name, boxes.tobytes()]
+    for digit, (_, _, w, h) in zip(digits, boxes):
+        if digit.ndim != 2:
+            raise ValueError("Only single channel digit masks can be packed")
+        if digit.shape != (h, w):
+            raise ValueError("Digit shape does not match its box")
+        chunks.append(np.packbits(digit.ravel() > 0).tobytes())
+    return b"".join(chunks)
+
+
+def unpack_card(data, offset=0):
+    """
+    Reads the record starting at offset in data, and returns (name, digits, boxes,
+    end): the card name, the list of uint8 masks with values 0 and 255, the (N, 4)
+    array of boxes and the offset just past the record.
+    """
+    marker, name_length, count = RECORD_HEADER.unpack_from(data, offset)
+    if marker != RECORD_MARKER:
+        raise ValueError("No card record at offset %d" % offset)
+    offset += RECORD_HEADER.size
+    name = bytes(data[offset:offset + name_length]).decode("utf-8")
+    offset += name_length
+    boxes = np.frombuffer(data, dtype=BOX_DTYPE, count=count * 4, offset=offset).reshape(count, 4)
+    offset += boxes.nbytes
+
+    digits = []
+    for _, _, w, h in boxes.astype(int):
+        packed_size = (w * h + 7) // 8
+        bits = np.frombuffer(data, dtype=np.uint8, count=packed_size, offset=offset)
+        digits.append(np.unpackbits(bits, count=w * h).reshape(h, w) * np.uint8(255))
+        offset += packed_size
+    return name, digits, boxes, offset
+
+
+def check_header(data):
+    """Returns the offset of the first record, after checking the file header"""
+    magic, version = FILE_HEADER.unpack_from(data, 0)
+    if magic != FILE_MAGIC:
+        raise ValueError("Not a packed digits file")
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported packed digits version: %d" % version)
+    return FILE_HEADER.size
+
+
+def write_card(path, name, digits, boxes):
+    """Writes the digits of one card to their own packed digits file at path"""
+    with open(path, "wb") as f:
+        f.write(FILE_HEADER.pack(FILE_MAGIC, FORMAT_VERSION))
+        f.write(pack_card(name, digits, boxes))
+
+
+def read_cards(path):
+    """Yields (name, digits, boxes) for each card of a packed digits file or shard, in order"""
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = check_header(data)
+    while offset < len(data):
+        name, digits, boxes, offset = unpack_card(data, offset)
+        yield name, digits, boxes
+
+
+class DigitShardWriter(object):
+    """
+    Appends the digits of many cards to one packed digits file, a shard, and
+    records where each card's record starts in an index next to it. Cards are
+    only ever appended, so a shard can be added to across runs.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the shard. Created if it does not exist, otherwise
+                appended to. The index is written to path + INDEX_SUFFIX.
+        """
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(FILE_MAGIC, FORMAT_VERSION))
+        self.index = open(self.index_path, "a")
+
+    def append(self, name, digits, boxes):
+        """Appends the digits of one card and returns the offset of its record"""
+        record = pack_card(name, digits, boxes)
+        offset = self.file.tell()
+        self.file.write(record)
+        self.file.flush()
+        # the record is written first, so the index never points past the data
+        self.index.write(json.dumps({'name': name, 'offset': offset, 'length': len(record),
+            'digits': len(digits)}) + "\n")
+        self.index.flush()
+        return offset
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+class DigitShardReader(object):
+    """
+    Random access to the cards of a shard by name, using its index. If the index is
+    missing, it is rebuilt by reading through the shard.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        index_path = path + INDEX_SUFFIX
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry['name']] = entry
+        else:
+            with open(path, "rb") as f:
+                data = f.read()
+            offset = check_header(data)
+            while offset < len(data):
+                name, digits, _, end = unpack_card(data, offset)
+                self.entries[name] = {'name': name, 'offset': offset, 'length': end - offset,
+                    'digits': len(digits)}
+                offset = end
+        self.file = open(path, "rb")
+        check_header(self.file.read(FILE_HEADER.size))
+
+    def names(self):
+        return list(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def get(self, name):
+        """Returns (digits, boxes) of the card called name"""
+        entry = self.entries[name]
+        self.file.seek(entry['offset'])
+        _, digits, boxes, _ = unpack_card(self.file.read(entry['length']))
+        return digits, boxes
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,133 @@
+# USAGE:
+# python evaluate.py <MANIFEST> [--heights 250 350 500] [--ocr] [--output evaluation.json]
+# Measures how accurately the document corners and digits are found in the photos
+# of a manifest written by synthetic.py, and how long detection takes, at each of
+# the detection heights. For example:
+# python synthetic.py --output synthetic --count 100
+# python evaluate.py synthetic/manifest.json --heights 250 350 500
+
+from scan import DocScanner
+from crop import warp_and_crop
+from extract_digits_2 import segment_digits
+from pipeline import DIGITS_CROP_PARAMS
+from pyimagesearch import transform
+import ocr
+import numpy as np
+import cv2
+
+import argparse
+import contextlib
+import json
+import os
+import time
+
+# A card counts as detected if every corner is within this fraction of the
+# card's diagonal of the true corner
+DETECTED_ERROR = 0.02
+
+def corner_errors(found, expected):
+    """
+    Returns the distance of each found corner from the matching expected corner, as
+    a fraction of the expected card's diagonal. expected is ordered top-left,
+    top-right, bottom-right, bottom-left; found may be in any order.
+    """
+    found = transform.order_points(np.asarray(found, dtype="float32").reshape(4, 2))
+    expected = np.asarray(expected, dtype="float32")
+    diagonal = np.linalg.norm(expected[2] - expected[0])
+    return np.linalg.norm(found - expected, axis=1) / diagonal
+
+def digit_accuracy(read, expected):
+    """Returns the fraction of the expected digits read correctly, position by position"""
+    matches = sum(1 for a, b in zip(read, expected) if a == b)
+    return matches / float(len(expected))
+
+def evaluate_image(scanner, image, entry, height, run_ocr):
+    """Returns a dict of the detection time and accuracy for one manifest entry"""
+    ratio = image.shape[0] / float(height)
+    rescaled_image = cv2.resize(image, (int(image.shape[1] / ratio), int(height)))
+
+    start = time.perf_counter()
+    screenCnt = scanner.get_contour(rescaled_image)
+    detection_time = time.perf_counter() - start
+
+    corners = screenCnt * ratio
+    errors = corner_errors(corners, entry['corners'])
+
+    cropped = warp_and_crop(image, corners, [DIGITS_CROP_PARAMS])[0]
+    digits = segment_digits(cropped)
+    result = {
+        'file': entry['file'],
+        'detection_ms': detection_time * 1000,
+        'corner_error': float(errors.mean()),
+        'max_corner_error': float(errors.max()),
+        'detected': bool(errors.max() < DETECTED_ERROR),
+        'digit_count_correct': len(digits) == len(entry['digits'])
+    }
+    if run_ocr:
+        read = "".join(d or "?" for d in ocr.recognize_digits(digits))
+        result['digits_read'] = read
+        result['digit_accuracy'] = digit_accuracy(read, entry['digits'])
+        result['digits_correct'] = read == entry['digits']
+    return result
+
+def summarize(results):
+    """Returns the averages over the per-image results of one detection height"""
+    errors = np.array([r['corner_error'] for r in results])
+    times = np.array([r['detection_ms'] for r in results])
+    summary = {
+        'images': len(results),
+        'detection_rate': float(np.mean([r['detected'] for r in results])),
+        'mean_corner_error': float(errors.mean()),
+        'p95_corner_error': float(np.percentile(errors, 95)),
+        'digit_count_rate': float(np.mean([r['digit_count_correct'] for r in results])),
+        'p50_detection_ms': float(np.percentile(times, 50)),
+        'p95_detection_ms': float(np.percentile(times, 95))
+    }
+    if 'digit_accuracy' in results[0]:
+        summary['digit_accuracy'] = float(np.mean([r['digit_accuracy'] for r in results]))
+        summary['exact_match_rate'] = float(np.mean([r['digits_correct'] for r in results]))
+    return summary
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("manifest", help="manifest.json written by synthetic.py")
+    ap.add_argument("--heights", type=float, nargs="+", default=[500.0],
+        help = "Heights the photos are rescaled to for detection")
+    ap.add_argument("--ocr", action='store_true',
+        help = "Also read the digits and measure how many are read correctly")
+    ap.add_argument("--output", help="JSON file the per-image results and summaries are written to")
+    args = vars(ap.parse_args())
+
+    with open(args["manifest"]) as f:
+        entries = json.load(f)['images']
+    image_dir = os.path.dirname(args["manifest"])
+
+    scanner = DocScanner()
+    results = {height: [] for height in args["heights"]}
+    for entry in entries:
+        image = cv2.imread(os.path.join(image_dir, entry['file']))
+        assert image is not None, f"Failed to load image: {entry['file']}"
+        for height in args["heights"]:
+            # the detection and segmentation steps print their progress
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                results[height].append(evaluate_image(scanner, image, entry, height, args["ocr"]))
+
+    summaries = {height: summarize(results[height]) for height in args["heights"]}
+    print("%8s %10s %12s %12s %12s %12s %12s" % ("height", "detected", "corner err", "p95 err",
+        "digit count", "p50(ms)", "p95(ms)"))
+    for height, s in summaries.items():
+        print("%8g %9.1f%% %11.2f%% %11.2f%% %11.1f%% %12.2f %12.2f" % (height,
+            100 * s['detection_rate'], 100 * s['mean_corner_error'], 100 * s['p95_corner_error'],
+            100 * s['digit_count_rate'], s['p50_detection_ms'], s['p95_detection_ms']))
+        if 'digit_accuracy' in s:
+            print("%8s digit accuracy %.1f%%, exact matches %.1f%%" % ("",
+                100 * s['digit_accuracy'], 100 * s['exact_match_rate']))
+
+    if args["output"]:
+        with open(args["output"], "w") as f:
+            json.dump({
+                'manifest': args["manifest"],
+                'summaries': {str(height): s for height, s in summaries.items()},
+                'results': {str(height): r for height, r in results.items()}
+            }, f, indent=2)
+        print("Saved evaluation to " + args["output"])
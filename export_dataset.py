@@ -0,0 +1,279 @@
+# USAGE:
+# python export_dataset.py <IMG_DIR> [--output dataset] [--shard-size 1024] [--workers N] [--no-ocr]
+# Runs the card pipeline over every image in IMG_DIR and exports the warped cards,
+# digit masks, corners and OCR text as fixed-record .npy shards plus an index.json,
+# which training and audit jobs can open with load_dataset() and memory map:
+# python export_dataset.py sample_images --output dataset --workers 4
+
+from pipeline import CardPipeline
+from scan import VALID_FORMATS
+import extract_digits_2
+import numpy as np
+import cv2
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import time
+
+# Size (height, width) the warped cards are resized to, the shape of an ID-1 card
+CARD_SHAPE = (270, 428)
+
+# Side of the square each digit mask is resized to
+DIGIT_SIZE = 32
+
+# Number of cards in each shard
+SHARD_SIZE = 1024
+
+INDEX_FILE = "index.json"
+
+
+def array_specs(max_digits=extract_digits_2.EXPECTED_DIGITS):
+    """Returns {name: (per-card shape, dtype)} of the arrays stored in every shard"""
+    return {
+        'cards': (CARD_SHAPE + (3,), np.uint8),
+        'digits': ((max_digits, DIGIT_SIZE, DIGIT_SIZE), np.uint8),
+        'digit_boxes': ((max_digits, 4), np.int32),
+        'digit_counts': ((), np.int32),
+        'corners': ((4, 2), np.float32)
+    }
+
+
+def card_record(result, max_digits=extract_digits_2.EXPECTED_DIGITS):
+    """
+    Returns the fixed size arrays stored for one CardPipeline.process() result: the
+    warped card resized to CARD_SHAPE, the first max_digits digit masks resized to
+    DIGIT_SIZE with their boxes in the digit region (zero past the last digit), the
+    number of digits and the card's corners in the photo.
+    """
+    specs = array_specs(max_digits)
+    record = {name: np.zeros(shape, dtype) for name, (shape, dtype) in specs.items()}
+    record['cards'][...] = cv2.resize(result['scanned'], CARD_SHAPE[::-1], interpolation=cv2.INTER_AREA)
+
+    digits = result['digits'][:max_digits]
+    for i, (digit, box) in enumerate(zip(digits, result['digit_boxes'])):
+        if digit.ndim == 3:
+            digit = cv2.cvtColor(digit, cv2.COLOR_BGR2GRAY)
+        record['digits'][i] = cv2.resize(digit, (DIGIT_SIZE, DIGIT_SIZE), interpolation=cv2.INTER_AREA)
+        record['digit_boxes'][i] = box
+    record['digit_counts'][...] = len(digits)
+    record['corners'][...] = np.asarray(result['contour'], dtype=np.float32).reshape(4, 2)
+    return record
+
+
+class ShardWriter(object):
+    """
+    Writes card records into a directory of shards, each holding one .npy file per
+    array of array_specs() with a row per card. Every shard is created at its full
+    size as a memory map and filled in place; the last one is cut down to the
+    cards it holds on close.
+    """
+
+    def __init__(self, directory, shard_size=SHARD_SIZE, max_digits=extract_digits_2.EXPECTED_DIGITS):
+        """
+        Args:
+            directory (str): Directory the shards are written to.
+            shard_size (int): Number of cards in each shard. Defaults to SHARD_SIZE.
+            max_digits (int): Number of digit masks stored per card. Defaults to
+                extract_digits_2.EXPECTED_DIGITS.
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        self.specs = array_specs(max_digits)
+        self.shards = []
+        self.arrays = None
+        self.row = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open_shard(self):
+        name = "shard_%05d" % len(self.shards)
+        os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+        self.shards.append({'name': name, 'count': 0})
+        self.arrays = {}
+        for array, (shape, dtype) in self.specs.items():
+            path = os.path.join(self.directory, name, array + ".npy")
+            self.arrays[array] = np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                shape=(self.shard_size,) + shape)
+        self.row = 0
+
+    def close_shard(self):
+        shard = self.shards[-1]
+        shard['count'] = self.row
+        trimmed = {}
+        for array, data in self.arrays.items():
+            data.flush()
+            if self.row < self.shard_size:
+                trimmed[array] = np.array(data[:self.row])
+        # unmap the arrays before rewriting the partly filled ones at their real length
+        self.arrays = None
+        for array, data in trimmed.items():
+            np.save(os.path.join(self.directory, shard['name'], array + ".npy"), data)
+
+    def append(self, record):
+        """Stores a card_record() and returns the (shard name, row) it was stored at"""
+        if self.arrays is None:
+            self.open_shard()
+        for array, data in self.arrays.items():
+            data[self.row] = record[array]
+        location = (self.shards[-1]['name'], self.row)
+        self.row += 1
+        if self.row == self.shard_size:
+            self.close_shard()
+        return location
+
+    def close(self):
+        if self.arrays is not None:
+            self.close_shard()
+
+
+class Dataset(object):
+    """
+    An exported dataset opened for reading. The shards' arrays are memory mapped
+    as they are first used, so cards are read straight from the page cache.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.cards = {card['id']: card for card in self.index['cards']}
+        self.mapped = {}
+
+    def __len__(self):
+        return len(self.index['cards'])
+
+    def ids(self):
+        return [card['id'] for card in self.index['cards']]
+
+    def array(self, shard, name):
+        """Returns the read-only memory map of array name in shard"""
+        key = (shard, name)
+        if key not in self.mapped:
+            self.mapped[key] = np.load(os.path.join(self.directory, shard, name + ".npy"), mmap_mode="r")
+        return self.mapped[key]
+
+    def get(self, card_id):
+        """
+        Returns a dict of the index entry of card_id, which includes the number of
+        'digits', and its arrays: the warped 'card', the 'digit_masks' and
+        'digit_boxes' (only the digits found), and 'corners'.
+        """
+        card = dict(self.cards[card_id])
+        shard, row = card['shard'], card['row']
+        count = int(self.array(shard, 'digit_counts')[row])
+        card['card'] = self.array(shard, 'cards')[row]
+        card['digit_masks'] = self.array(shard, 'digits')[row, :count]
+        card['digit_boxes'] = self.array(shard, 'digit_boxes')[row, :count]
+        card['corners'] = self.array(shard, 'corners')[row]
+        return card
+
+
+def load_dataset(directory):
+    """Opens a dataset written by export_dataset()"""
+    return Dataset(directory)
+
+
+# pipeline owned by each worker process, created once by _init_worker
+_worker_pipeline = None
+
+def _init_worker(pipeline_kwargs):
+    global _worker_pipeline
+    # each process already gets its own core, so keep OpenCV from spawning
+    # a thread pool per worker and oversubscribing the machine
+    cv2.setNumThreads(1)
+    _worker_pipeline = CardPipeline(**pipeline_kwargs)
+
+def _export_one(input_path):
+    """
+    Runs the pipeline on one image, returning (input_path, error message or None,
+    card_record() or None, OCR results)
+    """
+    try:
+        # the pipeline prints its progress, which would drown out the export's
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            image = cv2.imread(input_path)
+            assert image is not None, f"Failed to load image: {input_path}"
+            result = _worker_pipeline.process(image)
+        ocr_results = {'ocr_result': result['ocr_result'], 'individual_digits': result['individual_digits']}
+        return input_path, None, card_record(result), ocr_results
+    except Exception as e:
+        return input_path, str(e), None, None
+
+def export_dataset(input_paths, output_dir, shard_size=SHARD_SIZE, workers=1, **pipeline_kwargs):
+    """
+    Runs a CardPipeline built from pipeline_kwargs on every image of input_paths,
+    across workers processes, and writes the results to shards in output_dir with
+    an index.json listing each card's id (its file name), source path, shard, row
+    and OCR text, and the images that failed. Returns the path of the index.
+    Raises ValueError if two of input_paths have the same file name.
+    """
+    ids = {}
+    for input_path in input_paths:
+        card_id = os.path.basename(input_path)
+        if card_id in ids:
+            raise ValueError(f"{ids[card_id]} and {input_path} would both get the card id {card_id}")
+        ids[card_id] = input_path
+
+    start = time.time()
+    writer = ShardWriter(output_dir, shard_size)
+    cards = []
+    failures = []
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(pipeline_kwargs,))
+    try:
+        # imap keeps the order of input_paths while only a few records are in flight
+        for input_path, error, record, ocr_results in pool.imap(_export_one, input_paths):
+            if error is not None:
+                print("Failed to export " + input_path + ": " + error)
+                failures.append({'source': input_path, 'error': error})
+                continue
+            shard, row = writer.append(record)
+            card = {
+                'id': os.path.basename(input_path),
+                'source': input_path,
+                'shard': shard,
+                'row': row,
+                'digits': int(record['digit_counts'])
+            }
+            card.update(ocr_results)
+            cards.append(card)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    with open(index_path, "w") as f:
+        json.dump({
+            'arrays': {name: {'shape': list(shape), 'dtype': np.dtype(dtype).str}
+                for name, (shape, dtype) in writer.specs.items()},
+            'shards': writer.shards,
+            'cards': cards,
+            'failed': failures
+        }, f, indent=2)
+
+    elapsed = time.time() - start
+    print("Exported %d/%d images to %d shards in %.2fs (%d workers), %d failed"
+        % (len(cards), len(input_paths), len(writer.shards), elapsed, workers, len(failures)))
+    return index_path
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("images", help="Directory of images to export")
+    ap.add_argument("--output", default="dataset",
+        help = "Directory the shards and index.json are written to")
+    ap.add_argument("--shard-size", type=int, default=SHARD_SIZE,
+        help = "Number of cards in each shard")
+    ap.add_argument("--workers", type=int, default=1,
+        help = "Number of processes to run the pipeline in")
+    ap.add_argument("--no-ocr", action='store_true',
+        help = "Export the images only, without reading the digits")
+    args = vars(ap.parse_args())
+
+    image_paths = sorted(os.path.join(args["images"], f) for f in os.listdir(args["images"])
+        if os.path.splitext(f)[1].lower() in VALID_FORMATS)
+    export_dataset(image_paths, args["output"], args["shard_size"], args["workers"],
+        run_ocr=not args["no_ocr"])
@@ -1,7 +1,7 @@
 import cv2
 import numpy as np
 import os
-from imutils import contours
+import digit_pack
 
 # Thresholding parameters
 BLUR_KERNEL_SIZE = 3
@@ -10,7 +10,14 @@ INVERT = False
 ORIGINAL = False
 EXPECTED_DIGITS = 15  # Number of digits we expect to find
 
-def extract_digits(image_path, output_dir='digits'):
+def extract_digits(image_path, output_dir='digits', packed=False, shard=None, debug=False):
+    """
+    Saves the digits found in the image at image_path to output_dir, as one PNG per
+    digit, or as a single packed digits file per card if packed is set (see
+    digit_pack). If shard, a digit_pack.DigitShardWriter, is given the digits are
+    appended to it instead. Debug images are written to output_dir/debug if debug
+    is set.
+    """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -20,7 +27,36 @@ def extract_digits(image_path, output_dir='digits'):
     base_name = os.path.splitext(os.path.basename(image_path))[0]
     image = cv2.imread(image_path)
     assert image is not None, "Failed to load image"
-    
+
+    debug_dir = os.path.join(output_dir, 'debug') if debug else None
+    digits, boxes = find_digits(image, debug_dir=debug_dir)
+
+    if shard is not None:
+        shard.append(base_name, digits, boxes)
+        print(f"Appended {len(digits)} digits to {shard.path}")
+    elif packed:
+        output_path = os.path.join(output_dir, f"{base_name}.digits")
+        digit_pack.write_card(output_path, base_name, digits, boxes)
+        print(f"Saved {len(digits)} digits to {output_path}")
+    else:
+        for i, digit in enumerate(digits):
+            output_path = os.path.join(output_dir, f"{base_name}_{i:03d}.png")
+            cv2.imwrite(output_path, digit)
+            print(f"Saved digit {i} to {output_path}")
+
+def segment_digits(image, debug_dir=None):
+    """
+    Returns the digits found in a BGR image of the digit region, left to right, as
+    a list of square arrays: single channel thresholded masks, or BGR crops of the
+    image when ORIGINAL is set. Debug images are written to debug_dir if given.
+    """
+    return find_digits(image, debug_dir)[0]
+
+def find_digits(image, debug_dir=None):
+    """
+    Like segment_digits(), but returns (digits, boxes), where boxes holds the
+    (x, y, w, h) of each digit in image.
+    """
     print(f"Image size: {image.shape}")
 
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -41,87 +77,95 @@ def extract_digits(image_path, output_dir='digits'):
         _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
 
     # Save debug images
-    debug_dir = os.path.join(output_dir, 'debug')
-    os.makedirs(debug_dir, exist_ok=True)
-    cv2.imwrite(os.path.join(debug_dir, 'gray.png'), gray)
-    cv2.imwrite(os.path.join(debug_dir, 'thresh.png'), thresh)
+    if debug_dir is not None:
+        os.makedirs(debug_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(debug_dir, 'gray.png'), gray)
+        cv2.imwrite(os.path.join(debug_dir, 'thresh.png'), thresh)
 
-    # Find contours
+    # Find contours, and gather their bounding boxes and areas into arrays for the
+    # filtering, sorting and squaring below, which run over all of them at once.
+    # The boxes and areas themselves are still taken one contour at a time with
+    # OpenCV, on purpose: findContours hands back a list of separate arrays, and
+    # doing the same sums over their concatenated points in NumPy only duplicated
+    # these two functions. This loop costs about half as much as findContours
+    # itself, a millisecond or two at most for a digit region
     contours_list, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     print(f"Found {len(contours_list)} initial contours")
+    rects = np.array([cv2.boundingRect(contour) for contour in contours_list], dtype=np.int64).reshape(-1, 4)
+    x, y, w, h = rects.T
+    area = np.array([cv2.contourArea(contour) for contour in contours_list])
 
     # Filter contours based on size and aspect ratio
-    filtered_contours = []
     min_area = (image.shape[0] * image.shape[1]) / 1000  # Reduced from 100
     max_area = (image.shape[0] * image.shape[1]) / 8    # Increased from 10
-    
-    for contour in contours_list:
-        x, y, w, h = cv2.boundingRect(contour)
-        area = cv2.contourArea(contour)
-        aspect_ratio = float(w) / h if h != 0 else 0
-        
-        # Print debug info for larger contours
-        if area > min_area / 2:
-            print(f"Contour - Area: {area:.0f}, Aspect: {aspect_ratio:.2f}, Size: {w}x{h}")
-        
-        # Filter conditions:
-        # 1. Minimum area to eliminate noise
-        # 2. Maximum area to eliminate large artifacts
-        # 3. Aspect ratio should be reasonable for digits (not too wide or tall)
-        if (area > min_area and
-            area < max_area and
-            0.1 < aspect_ratio < 4.0):  # Relaxed from 0.2-3.0
-            filtered_contours.append(contour)
-
-    print(f"Found {len(filtered_contours)} contours after filtering")
-
-    # Sort remaining contours left-to-right
-    if filtered_contours:
-        sorted_contours, _ = contours.sort_contours(filtered_contours, method="left-to-right")
-        
-        # Take only the expected number of digits
-        sorted_contours = sorted_contours[:EXPECTED_DIGITS]
-        print(f"Processing {len(sorted_contours)} contours")
-
-        # Draw debug image with contours
-        debug_image = image.copy()
-        for i, contour in enumerate(sorted_contours):
-            x, y, w, h = cv2.boundingRect(contour)
-            cv2.rectangle(debug_image, (x, y), (x+w, y+h), (0, 255, 0), 2)
-            cv2.putText(debug_image, str(i), (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
-        cv2.imwrite(os.path.join(debug_dir, 'contours.png'), debug_image)
-
-        # Process each contour
-        for i, contour in enumerate(sorted_contours):
-            x, y, w, h = cv2.boundingRect(contour)
-            
-            # Make bounding box square
-            size = max(w, h)
-            w_diff = size - w
-            h_diff = size - h
-            x = max(0, x - w_diff // 2)
-            y = max(0, y - h_diff // 2)
-            size = min(size, image.shape[1] - x, image.shape[0] - y)
-            
-            if ORIGINAL:
-                digit = image[y:y+size, x:x+size]
-            else:
-                digit = thresh[y:y+size, x:x+size]
-                digit = cv2.cvtColor(digit, cv2.COLOR_GRAY2BGR)
-            
-            if INVERT and not ORIGINAL:
-                digit = cv2.bitwise_not(digit)
-            
-            output_path = os.path.join(output_dir, f"{base_name}_{i:03d}.png")
-            cv2.imwrite(output_path, digit)
-            print(f"Saved digit {i} to {output_path}")
+    aspect_ratio = w / h.astype(np.float64)
+
+    # Print debug info for larger contours
+    for i in np.flatnonzero(area > min_area / 2):
+        print(f"Contour - Area: {area[i]:.0f}, Aspect: {aspect_ratio[i]:.2f}, Size: {w[i]}x{h[i]}")
+
+    # Filter conditions:
+    # 1. Minimum area to eliminate noise
+    # 2. Maximum area to eliminate large artifacts
+    # 3. Aspect ratio should be reasonable for digits (not too wide or tall)
+    keep = ((area > min_area) &
+            (area < max_area) &
+            (0.1 < aspect_ratio) & (aspect_ratio < 4.0))  # Relaxed from 0.2-3.0
+    print(f"Found {np.count_nonzero(keep)} contours after filtering")
+
+    # Sort remaining contours left-to-right and take only the expected number of digits
+    order = np.flatnonzero(keep)
+    order = order[np.argsort(x[order], kind="stable")][:EXPECTED_DIGITS]
+    x, y, w, h = x[order], y[order], w[order], h[order]
+
+    digits = []
+    boxes = []
+    if len(order):
+        print(f"Processing {len(order)} contours")
+
+        # Draw debug image with the bounding boxes
+        if debug_dir is not None:
+            debug_image = image.copy()
+            for i in range(len(order)):
+                cv2.rectangle(debug_image, (x[i], y[i]), (x[i]+w[i], y[i]+h[i]), (0, 255, 0), 2)
+                cv2.putText(debug_image, str(i), (x[i], y[i]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+            cv2.imwrite(os.path.join(debug_dir, 'contours.png'), debug_image)
+
+        # Make bounding boxes square, centred on the digits and kept inside the image
+        size = np.maximum(w, h)
+        x = np.maximum(0, x - (size - w) // 2)
+        y = np.maximum(0, y - (size - h) // 2)
+        size = np.minimum(size, np.minimum(image.shape[1] - x, image.shape[0] - y))
+
+        if ORIGINAL:
+            source = image
+        elif INVERT:
+            source = cv2.bitwise_not(thresh)
+        else:
+            source = thresh
+
+        boxes = np.stack([x, y, size, size], axis=1).tolist()
+        digits = [source[top:top+side, left:left+side] for left, top, side, _ in boxes]
     else:
         print("No valid contours found after filtering!")
 
+    return digits, boxes
+
 if __name__ == "__main__":
     import argparse
-    parser = argparse.ArgumentParser(description='Extract digits from an image')
-    parser.add_argument('image_path', help='Path to the input image')
+    parser = argparse.ArgumentParser(description='Extract digits from images')
+    parser.add_argument('image_paths', nargs='+', help='Paths to the input images')
+    parser.add_argument('--output-dir', default='digits', help='Directory the digits are saved to')
+    parser.add_argument('--packed', action='store_true',
+                        help='Save each card\'s digits as one packed file instead of a PNG per digit')
+    parser.add_argument('--shard', help='Append the digits of all the images to this packed shard')
+    parser.add_argument('--debug', action='store_true', help='Also save debug images')
     args = parser.parse_args()
 
-    extract_digits(args.image_path)
\ No newline at end of file
+    shard = digit_pack.DigitShardWriter(args.shard) if args.shard else None
+    try:
+        for image_path in args.image_paths:
+            extract_digits(image_path, args.output_dir, args.packed, shard, args.debug)
+    finally:
+        if shard is not None:
+            shard.close()
\ No newline at end of file
@@ -0,0 +1,152 @@
+import bisect
+import contextlib
+import time
+
+# Upper bounds in seconds of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the buckets for per-image counts, such as corners found
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+
+class Histogram(object):
+    """Counts observed values in fixed buckets, keeping their sum and maximum"""
+
+    def __init__(self, buckets):
+        """
+        Args:
+            buckets (tuple): Increasing upper bounds of the buckets. Values above the
+                last bound are counted in an extra overflow bucket.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Adds the observations of another histogram with the same buckets"""
+        assert self.buckets == other.buckets, "Histogram buckets differ"
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+class Metrics(object):
+    """
+    Latency histograms for the stages of the pipeline, and histograms of per-image
+    counts such as the number of corners found. A Metrics is plain data, so the
+    metrics gathered in a worker process can be sent back and merged into the
+    parent's.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """Context manager recording the time spent in its block as stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_latency(stage, time.perf_counter() - start)
+
+    def observe_latency(self, stage, seconds):
+        histogram = self.latencies.get(stage)
+        if histogram is None:
+            histogram = self.latencies[stage] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def observe_count(self, name, value):
+        histogram = self.counts.get(name)
+        if histogram is None:
+            histogram = self.counts[name] = Histogram(COUNT_BUCKETS)
+        histogram.observe(value)
+
+    def merge(self, other):
+        """Adds the observations of another Metrics to this one"""
+        for target, source in ((self.latencies, other.latencies), (self.counts, other.counts)):
+            for name, histogram in source.items():
+                if name in target:
+                    target[name].merge(histogram)
+                else:
+                    target[name] = Histogram(histogram.buckets)
+                    target[name].merge(histogram)
+
+    def summary(self):
+        """Returns a table of the calls and timings of each stage and of the counts"""
+        lines = ["%-18s %8s %10s %10s %10s %10s" % ("stage", "calls", "total(s)", "mean(ms)", "p95(ms)", "max(ms)")]
+        for stage, h in sorted(self.latencies.items(), key=lambda item: -item[1].sum):
+            lines.append("%-18s %8d %10.3f %10.2f %10s %10.2f" % (stage, h.count, h.sum,
+                1000 * h.sum / h.count, "<=%g" % (1000 * h.quantile(0.95)), 1000 * h.max))
+        if self.counts:
+            lines.append("")
+            lines.append("%-18s %8s %10s %10s" % ("count", "images", "mean", "max"))
+            for name, h in sorted(self.counts.items()):
+                lines.append("%-18s %8d %10.1f %10d" % (name, h.count, h.sum / h.count, h.max))
+        return "\n".join(lines)
+
+    def to_prometheus(self, prefix="docscanner"):
+        """Returns the histograms in the Prometheus text exposition format"""
+        lines = []
+        families = (
+            ("stage_seconds", "stage", self.latencies, "Time spent in each stage of the pipeline"),
+            ("stage_items", "name", self.counts, "Number of items found per image by a stage"))
+        for family, label, histograms, help_text in families:
+            if not histograms:
+                continue
+            metric = f"{prefix}_{family}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, h in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {h.sum:.6f}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+
+# metrics recorded by this process, replaced by collect()
+_metrics = Metrics()
+
+def timed(stage):
+    """Context manager recording the time spent in its block as stage in this process's metrics"""
+    return _metrics.time(stage)
+
+def observe_count(name, value):
+    """Records a per-image count in this process's metrics"""
+    _metrics.observe_count(name, value)
+
+def get_metrics():
+    """Returns the metrics recorded by this process"""
+    return _metrics
+
+def collect():
+    """Returns the metrics recorded by this process so far and starts afresh"""
+    global _metrics
+    collected, _metrics = _metrics, Metrics()
+    return collected
@@ -0,0 +1,318 @@
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+
+import os
+import queue
+import re
+import threading
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Tesseract configurations using the Arabic digits trained data, for a whole
+# region of digits, for a single digit (PSM 10) and for a strip of separated
+# digits read as one line (PSM 7)
+REGION_CONFIG = r'--oem 3 --psm 6 -l ara_number outputbase digits'
+DIGIT_CONFIG = r'--oem 3 --psm 10 -l ara_number outputbase digits'
+STRIP_CONFIG = r'--oem 3 --psm 7 -l ara_number outputbase digits'
+
+# Directory holding ara_number.traineddata for the in-process Tesseract backend.
+# Defaults to TESSDATA_PREFIX, or this repository if the model was left here
+TESSDATA_DIR = os.environ.get("TESSDATA_PREFIX") or (
+    os.path.dirname(os.path.abspath(__file__))
+    if os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ara_number.traineddata"))
+    else None)
+
+# Digits with less than this fraction of the largest digit's pixel area are zeros
+ZERO_AREA_RATIO = 0.30
+
+
+def to_pil(image):
+    """Converts a BGR or single channel numpy image to a PIL image for Tesseract"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(image)
+
+
+def to_gray(image):
+    """Returns a single channel copy of a BGR image, or the image itself if it already is"""
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def digit_areas(digits):
+    """Returns the number of non-zero pixels of each digit image"""
+    return [cv2.countNonZero(to_gray(digit)) for digit in digits]
+
+
+class PytesseractBackend(object):
+    """Runs the tesseract program through pytesseract, starting it afresh on every call"""
+
+    def image_to_string(self, image, config):
+        """Returns the text Tesseract reads in a numpy image using the config options"""
+        return pytesseract.image_to_string(to_pil(image), config=config)
+
+    def image_to_boxes(self, image, config):
+        """
+        Returns a (char, left, top, right, bottom) tuple for each character Tesseract
+        reads in a numpy image using the config options, in image coordinates.
+        """
+        height = image.shape[0]
+        boxes = []
+        for line in pytesseract.image_to_boxes(to_pil(image), config=config).splitlines():
+            fields = line.split(' ')
+            if len(fields) < 5:
+                continue
+            # tesseract box files measure y from the bottom of the image
+            char, left, bottom, right, top = fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4])
+            boxes.append((char, left, height - top, right, height - bottom))
+        return boxes
+
+
+class TesserocrBackend(object):
+    """
+    Runs Tesseract in-process through tesserocr, keeping a pool of long-lived API
+    handles per language so each model is loaded once per handle rather than on
+    every call. One handle per language of langs is created up front to check the
+    model loads; the rest are created on first use, up to size per language, and
+    calls from other threads wait for a free one.
+    """
+
+    def __init__(self, size=1, path=TESSDATA_DIR, langs=("ara_number",)):
+        """
+        Args:
+            size (int): Maximum number of API handles per language. Defaults to 1.
+            path (str): Directory holding the traineddata files. Defaults to
+                TESSDATA_DIR.
+            langs (tuple): Languages to create a handle for straight away, so that a
+                missing model or a wrong path raises here rather than on the first
+                image. Defaults to the language of the default configs.
+        """
+        if tesserocr is None:
+            raise ImportError("tesserocr is not installed")
+        self.size = size
+        self.path = path
+        self.pools = {}
+        self.created = {}
+        self.lock = threading.Lock()
+        for lang in langs:
+            api = self.acquire(lang)
+            self.pools[lang].put(api)
+
+    def parse_config(self, config):
+        """
+        Returns the (language, page segmentation mode, character whitelist) set by a
+        tesseract command line config string such as REGION_CONFIG.
+        """
+        lang = re.search(r'-l\s+(\S+)', config)
+        psm = re.search(r'--psm\s+(\d+)', config)
+        # the "digits" config file restricts recognition to 0-9
+        whitelist = "0123456789" if re.search(r'\bdigits\b', config) else ""
+        return (lang.group(1) if lang else "eng",
+                int(psm.group(1)) if psm else tesserocr.PSM.SINGLE_BLOCK,
+                whitelist)
+
+    def acquire(self, lang):
+        """Takes a free API handle for lang from the pool, creating one if allowed"""
+        with self.lock:
+            pool = self.pools.setdefault(lang, queue.Queue())
+            create = pool.empty() and self.created.get(lang, 0) < self.size
+            if create:
+                self.created[lang] = self.created.get(lang, 0) + 1
+        if create:
+            kwargs = {'lang': lang, 'oem': tesserocr.OEM.DEFAULT}
+            if self.path is not None:
+                kwargs['path'] = self.path
+            try:
+                return tesserocr.PyTessBaseAPI(**kwargs)
+            except Exception:
+                with self.lock:
+                    self.created[lang] -= 1
+                raise
+        return pool.get()
+
+    def run(self, image, config, read):
+        """Sets image on a pooled handle configured from config and returns read(handle)"""
+        lang, psm, whitelist = self.parse_config(config)
+        api = self.acquire(lang)
+        try:
+            api.SetPageSegMode(psm)
+            api.SetVariable("tessedit_char_whitelist", whitelist)
+            api.SetImage(to_pil(image))
+            return read(api)
+        finally:
+            api.Clear()
+            self.pools[lang].put(api)
+
+    def image_to_string(self, image, config):
+        """Returns the text Tesseract reads in a numpy image using the config options"""
+        return self.run(image, config, lambda api: api.GetUTF8Text())
+
+    def image_to_boxes(self, image, config):
+        """
+        Returns a (char, left, top, right, bottom) tuple for each character Tesseract
+        reads in a numpy image using the config options, in image coordinates.
+        """
+        def read(api):
+            api.Recognize()
+            boxes = []
+            iterator = api.GetIterator()
+            level = tesserocr.RIL.SYMBOL
+            # the iterator of a page without any text has nothing to read
+            while iterator is not None and not iterator.Empty(level):
+                char = iterator.GetUTF8Text(level)
+                box = iterator.BoundingBox(level)
+                if char and box:
+                    boxes.append((char,) + tuple(box))
+                if not iterator.Next(level):
+                    break
+            return boxes
+        return self.run(image, config, read)
+
+
+# backend used when none is passed in, created by get_default_backend
+_default_backend = None
+
+def get_default_backend():
+    """
+    Returns the shared default OCR backend: the in-process TesserocrBackend when
+    tesserocr is installed and can load the model, otherwise the pytesseract
+    command line fallback.
+    """
+    global _default_backend
+    if _default_backend is None:
+        if tesserocr is None:
+            print("tesserocr is not installed, using the pytesseract OCR backend")
+            _default_backend = PytesseractBackend()
+        else:
+            try:
+                _default_backend = TesserocrBackend()
+                print(f"Using the tesserocr OCR backend with tessdata from {TESSDATA_DIR}")
+            except Exception as e:
+                print(f"tesserocr failed to start ({e}), using the pytesseract OCR backend")
+                _default_backend = PytesseractBackend()
+    return _default_backend
+
+
+def tile_digits(digits):
+    """
+    Lays the digit images out left to right on a single strip, vertically centred
+    and separated by a gap as wide as the largest digit, so Tesseract reads them as
+    separate characters. Returns the strip and the (start, end) x range of each
+    digit on it. The strip is filled with the digits' own background level.
+    """
+    digits = [to_gray(digit) for digit in digits]
+    size = max(max(digit.shape) for digit in digits)
+    gap = size
+    borders = np.concatenate([
+        np.concatenate([d[0], d[-1], d[:, 0], d[:, -1]]) for d in digits])
+    background = int(np.median(borders))
+
+    height = size + 2 * gap
+    width = gap + sum(digit.shape[1] + gap for digit in digits)
+    strip = np.full((height, width), background, dtype=np.uint8)
+
+    spans = []
+    x = gap
+    for digit in digits:
+        h, w = digit.shape
+        y = (height - h) // 2
+        strip[y:y+h, x:x+w] = digit
+        spans.append((x, x + w))
+        x += w + gap
+    return strip, spans
+
+
+def recognize_digit_strip(digits, config=STRIP_CONFIG, backend=None, digit_config=DIGIT_CONFIG):
+    """
+    Reads all of the single digit images with one Tesseract call by tiling them on
+    a strip. Each recognised character is mapped back to the digit whose span its
+    box is centred closest to. Digits that did not get exactly one character, as
+    when Tesseract finds nothing in a digit's span or splits it in two, are read
+    again on their own with digit_config, as recognize_digits() would without the
+    strip. Returns the text read for each digit.
+    """
+    backend = backend or get_default_backend()
+    strip, spans = tile_digits(digits)
+    boxes = backend.image_to_boxes(strip, config)
+
+    # a character belongs to the digit whose span its centre falls in, with the
+    # gaps between digits split down the middle
+    bounds = [(end + start) / 2.0 for (_, end), (start, _) in zip(spans, spans[1:])]
+
+    results = [''] * len(digits)
+    for char, left, _, right, _ in boxes:
+        index = int(np.searchsorted(bounds, (left + right) / 2.0))
+        results[index] += char
+
+    for i, digit in enumerate(digits):
+        if len(results[i]) == 1:
+            continue
+        try:
+            results[i] = backend.image_to_string(digit, digit_config).strip()
+        except Exception as e:
+            print(f"Error during individual digit OCR: {str(e)}")
+            results[i] = "?"
+    return results
+
+
+def recognize_region(image, config=REGION_CONFIG, backend=None):
+    """Returns the digits Tesseract reads in an image of the whole digit region"""
+    backend = backend or get_default_backend()
+    try:
+        return backend.image_to_string(image, config).strip()
+    except Exception as e:
+        print(f"Error during OCR: {str(e)}")
+        return "OCR Failed"
+
+
+def recognize_digits(digits, config=DIGIT_CONFIG, strip_config=STRIP_CONFIG, backend=None,
+        classifier=None):
+    """
+    Returns the digit read from each of the single digit images. Digits much smaller
+    than the largest one are taken to be zeros without running Tesseract, and "?" is
+    returned for digits Tesseract fails on. If a DigitClassifier is given, it labels
+    the other digits first and only those it is not confident about go on to
+    Tesseract. The remaining digits are read together in one call with
+    recognize_digit_strip(), or one call each with config if strip_config is None.
+    """
+    backend = backend or get_default_backend()
+    areas = digit_areas(digits)
+    max_area = max(areas) if areas else 0
+    area_threshold = max_area * ZERO_AREA_RATIO
+
+    # If area is less than threshold, classify as zero; otherwise perform OCR
+    individual_digits = ['0' if area < area_threshold else None for area in areas]
+    to_read = [i for i, digit in enumerate(individual_digits) if digit is None]
+
+    # Let the classifier label every digit it is confident about in one call
+    if classifier is not None and to_read:
+        labels, confidences = classifier.classify([digits[i] for i in to_read])
+        for i, label, confidence in zip(to_read, labels, confidences):
+            if confidence >= classifier.min_confidence:
+                individual_digits[i] = str(label)
+        to_read = [i for i in to_read if individual_digits[i] is None]
+
+    if strip_config is not None and to_read:
+        try:
+            strip_results = recognize_digit_strip([digits[i] for i in to_read], strip_config, backend, config)
+        except Exception as e:
+            print(f"Error during individual digit OCR: {str(e)}")
+            strip_results = ["?"] * len(to_read)
+        for i, digit_result in zip(to_read, strip_results):
+            individual_digits[i] = digit_result
+        return individual_digits
+
+    for i in to_read:
+        try:
+            digit_result = backend.image_to_string(digits[i], config).strip()
+            individual_digits[i] = digit_result
+        except Exception as e:
+            print(f"Error during individual digit OCR: {str(e)}")
+            individual_digits[i] = "?"
+    return individual_digits
@@ -0,0 +1,247 @@
+from scan import DocScanner
+from crop import warp_and_crop, crop_image
+from extract_digits_2 import find_digits
+import extract_digits_2
+import scan
+import crop
+import digit_classifier
+from pyimagesearch import transform
+from pyimagesearch import imutils
+import ocr
+import metrics
+import digit_pack
+import numpy as np
+import cv2
+
+import hashlib
+import os
+import sys
+
+# Crop of the scanned ID card holding the digits: (top, bottom, left, right)
+DIGITS_CROP_PARAMS = (0.75, 0.14, 0.4, 0)
+
+# Crop params that keep the whole scanned card
+WHOLE_DOCUMENT = (0, 0, 0, 0)
+
+
+def code_version():
+    """
+    Returns a SHA-256 of the source of the modules that decide the results of
+    CardPipeline.process(), so that results cached by an older version of the
+    code are not served after it changes
+    """
+    digest = hashlib.sha256()
+    for module in (scan, crop, extract_digits_2, ocr, digit_classifier, transform, imutils,
+            sys.modules[__name__]):
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class CardPipeline(object):
+    """
+    Scans an ID card photo, crops the digit region, splits it into digits and reads
+    them, passing numpy images between the stages without touching the disk.
+    Results can be written out afterwards with save(). The pipeline keeps no
+    per-image state, so a single instance can serve concurrent requests.
+    """
+
+    def __init__(self, scanner=None, crop_params=DIGITS_CROP_PARAMS, run_ocr=True,
+            region_config=ocr.REGION_CONFIG, digit_config=ocr.DIGIT_CONFIG,
+            strip_config=ocr.STRIP_CONFIG, ocr_backend=None, digit_classifier=None):
+        """
+        Args:
+            scanner (DocScanner): Scanner used to find the card. Defaults to a
+                non-interactive DocScanner.
+            crop_params (tuple): (top, bottom, left, right) fractions of the scanned
+                card to crop the digits from. Defaults to DIGITS_CROP_PARAMS.
+            run_ocr (boolean): If False, the digits are extracted but not read.
+                Defaults to True.
+            region_config (str): Tesseract configuration for reading the whole digit
+                region. Defaults to ocr.REGION_CONFIG.
+            digit_config (str): Tesseract configuration for reading single digits.
+                Defaults to ocr.DIGIT_CONFIG.
+            strip_config (str): Tesseract configuration for reading all of the digits
+                in one call, tiled on a strip. If None, each digit is read with its own
+                call using digit_config. Defaults to ocr.STRIP_CONFIG.
+            ocr_backend: Backend that runs Tesseract, such as ocr.TesserocrBackend or
+                ocr.PytesseractBackend. Defaults to ocr.get_default_backend(), which is
+                only created once the first digits are read, so a pipeline built just
+                for its params() loads no OCR model.
+            digit_classifier (DigitClassifier): If given, labels the digits before
+                Tesseract, which then only reads the digits the classifier is not
+                confident about. Defaults to None.
+        """
+        self.scanner = scanner if scanner is not None else DocScanner(interactive=False)
+        self.crop_params = crop_params
+        self.run_ocr = run_ocr
+        self.region_config = region_config
+        self.digit_config = digit_config
+        self.strip_config = strip_config
+        self.ocr_backend = ocr_backend
+        self.digit_classifier = digit_classifier
+
+    def params(self):
+        """
+        Returns a JSON-serialisable dict of every setting that affects the results of
+        process(), for keying cached results.
+        """
+        classifier = None
+        if self.digit_classifier is not None:
+            classifier = hashlib.sha256(self.digit_classifier.samples.tobytes()
+                + self.digit_classifier.labels.tobytes()).hexdigest()
+        return {
+            'MIN_QUAD_AREA_RATIO': self.scanner.MIN_QUAD_AREA_RATIO,
+            'MAX_QUAD_ANGLE_RANGE': self.scanner.MAX_QUAD_ANGLE_RANGE,
+            'lsd_params': self.scanner.lsd_params,
+            'coarse_to_fine': self.scanner.coarse_to_fine,
+            'subpixel_corners': self.scanner.subpixel_corners,
+            'crop_params': list(self.crop_params),
+            'BLUR_KERNEL_SIZE': extract_digits_2.BLUR_KERNEL_SIZE,
+            'USE_ADAPTIVE': extract_digits_2.USE_ADAPTIVE,
+            'INVERT': extract_digits_2.INVERT,
+            'ORIGINAL': extract_digits_2.ORIGINAL,
+            'EXPECTED_DIGITS': extract_digits_2.EXPECTED_DIGITS,
+            'run_ocr': self.run_ocr,
+            'region_config': self.region_config,
+            'digit_config': self.digit_config,
+            'strip_config': self.strip_config,
+            'ocr_backend': type(self.ocr_backend).__name__ if self.ocr_backend is not None else 'default',
+            'tessdata_dir': getattr(self.ocr_backend, 'path', ocr.TESSDATA_DIR),
+            'digit_classifier': classifier,
+            'code_version': code_version()
+        }
+
+    def warm_up(self):
+        """
+        Runs the pipeline once on a small synthetic card, so that lazy library
+        initialisation happens now rather than on the first real image.
+        """
+        image = np.full((500, 700, 3), 40, dtype=np.uint8)
+        cv2.rectangle(image, (100, 100), (600, 400), (230, 230, 230), -1)
+        cv2.putText(image, "0123456789", (320, 350), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (20, 20, 20), 2)
+        self.process(image)
+
+    def process(self, image):
+        """
+        Runs the pipeline on a BGR image and returns a dict with the document
+        'contour' in image coordinates, a 'scanned' preview of the card, the
+        'cropped' digit region, the list of 'digits' images and their (x, y, w, h)
+        'digit_boxes' in the region, and the 'ocr_result' of the whole region and
+        'individual_digits' read one by one (None if OCR is disabled).
+        """
+        RESCALED_HEIGHT = 500.0
+
+        # Get the contour of the document
+        ratio = image.shape[0] / RESCALED_HEIGHT
+        with metrics.timed("resize"):
+            rescaled_image = cv2.resize(image, (int(image.shape[1] / ratio), int(RESCALED_HEIGHT)))
+        screenCnt = self.scanner.get_contour(rescaled_image)
+
+        # Warp and sharpen the whole card from the full resolution image, and
+        # take the digit region from it
+        scanned = warp_and_crop(image, screenCnt * ratio, [WHOLE_DOCUMENT])[0]
+        with metrics.timed("crop"):
+            cropped = crop_image(scanned, self.crop_params)
+
+        with metrics.timed("segment_digits"):
+            digits, digit_boxes = find_digits(cropped)
+        metrics.observe_count("digits", len(digits))
+
+        ocr_result = None
+        individual_digits = None
+        if self.run_ocr:
+            with metrics.timed("ocr_region"):
+                ocr_result = ocr.recognize_region(cropped, self.region_config, self.ocr_backend)
+            with metrics.timed("ocr_digits"):
+                individual_digits = ocr.recognize_digits(
+                    digits, self.digit_config, self.strip_config, self.ocr_backend,
+                    self.digit_classifier)
+
+        return {
+            'contour': screenCnt * ratio,
+            'scanned': scanned,
+            'cropped': cropped,
+            'digits': digits,
+            'digit_boxes': digit_boxes,
+            'ocr_result': ocr_result,
+            'individual_digits': individual_digits
+        }
+
+    def save(self, result, output_dir, name, ext='.jpg', packed_digits=False):
+        """
+        Writes the images of a process() result to output_dir, using the same file
+        names as the scan -> crop -> extract_digits scripts, and returns a dict with
+        the 'scanned', 'cropped' and 'digits' paths. If packed_digits is set, the
+        digits are written to a single packed digits file (see digit_pack), and
+        'digits' holds its path alone.
+        """
+        output_dir = str(output_dir)
+        digits_dir = os.path.join(output_dir, 'digits')
+        os.makedirs(digits_dir, exist_ok=True)
+
+        scanned_path = os.path.join(output_dir, f"{name}_scanned{ext}")
+        cropped_path = os.path.join(output_dir, f"{name}_scanned_crop_0{ext}")
+        digit_paths = []
+        with metrics.timed("encode"):
+            cv2.imwrite(scanned_path, result['scanned'])
+            cv2.imwrite(cropped_path, result['cropped'])
+
+            if packed_digits:
+                digit_path = os.path.join(digits_dir, f"{name}_scanned_crop_0.digits")
+                digit_pack.write_card(digit_path, name, result['digits'], result['digit_boxes'])
+                digit_paths.append(digit_path)
+            else:
+                for i, digit in enumerate(result['digits']):
+                    digit_path = os.path.join(digits_dir, f"{name}_scanned_crop_0_{i:03d}.png")
+                    cv2.imwrite(digit_path, digit)
+                    digit_paths.append(digit_path)
+
+        return {
+            'scanned': scanned_path,
+            'cropped': cropped_path,
+            'digits': digit_paths
+        }
+
+
+# pipeline owned by each worker process, created once by init_worker
+_worker_pipeline = None
+
+def init_worker(pipeline_kwargs=None):
+    """
+    Process pool initializer: builds and warms up the pipeline used by
+    process_file() in this worker process.
+    """
+    global _worker_pipeline
+    # each worker already gets its own core, so keep OpenCV from spawning
+    # a thread pool per worker and oversubscribing the machine
+    cv2.setNumThreads(1)
+    _worker_pipeline = CardPipeline(**(pipeline_kwargs or {}))
+    _worker_pipeline.warm_up()
+    # the warm-up is not a real request, so keep it out of the metrics
+    metrics.collect()
+
+def process_file(input_path, output_dir):
+    """
+    Runs the worker's pipeline on the image at input_path and saves the results
+    to output_dir. Only the saved paths, the contour, OCR text and the stage
+    'metrics' recorded for this image are returned, so no images are sent back
+    between processes.
+    """
+    if _worker_pipeline is None:
+        init_worker()
+
+    name, ext = os.path.splitext(os.path.basename(str(input_path)))
+    with metrics.timed("decode"):
+        image = cv2.imread(str(input_path))
+    assert image is not None, f"Failed to load image: {input_path}"
+
+    result = _worker_pipeline.process(image)
+    print(f"Extracted {len(result['digits'])} digits")
+    saved = _worker_pipeline.save(result, output_dir, name, ext)
+
+    saved['contour'] = result['contour'].reshape(4, 2).tolist()
+    saved['ocr_result'] = result['ocr_result']
+    saved['individual_digits'] = result['individual_digits']
+    saved['metrics'] = metrics.collect()
+    return saved
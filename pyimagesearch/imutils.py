@@ -55,4 +55,13 @@ def resize(image, width = None, height = None, inter = cv2.INTER_AREA):
 	resized = cv2.resize(image, dim, interpolation = inter)
 
 	# return the resized image
-	return resized
\ No newline at end of file
+	return resized
+
+def sharpen(image, sigma = 3):
+	# sharpen the image with an unsharp mask: subtract a blurred copy
+	# of the image from a weighted copy of itself
+	blurred = cv2.GaussianBlur(image, (0, 0), sigma)
+	sharpened = cv2.addWeighted(image, 1.5, blurred, -0.5, 0)
+
+	# return the sharpened image
+	return sharpened
\ No newline at end of file
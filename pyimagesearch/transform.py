@@ -30,7 +30,34 @@ def order_points(pts):
     # bottom-right, and bottom-left order
     return np.array([tl, tr, br, bl], dtype = "float32")
 
-def four_point_transform(image, pts):
+def order_points_batch(pts):
+    # vectorized order_points for an (N, 4, 2) array of quadrilaterals,
+    # breaking ties exactly the way order_points does for each one
+    pts = np.asarray(pts)
+    rows = np.arange(pts.shape[0])[:, np.newaxis]
+
+    # sort the points of every quad based on their x-coordinates
+    xSorted = pts[rows, np.argsort(pts[:, :, 0], axis=1, kind="stable")]
+    leftMost = xSorted[:, :2]
+    rightMost = xSorted[:, 2:]
+
+    # sort the left-most coordinates according to their y-coordinates
+    # to grab the top-left and bottom-left points
+    leftMost = leftMost[rows, np.argsort(leftMost[:, :, 1], axis=1, kind="stable")]
+    tl = leftMost[:, 0]
+    bl = leftMost[:, 1]
+
+    # the right-most point furthest from the top-left is the bottom-right
+    D = np.sqrt(((rightMost - tl[:, np.newaxis]).astype("float64") ** 2).sum(axis=2))
+    farther = (D[:, 0] <= D[:, 1])[:, np.newaxis]
+    br = np.where(farther, rightMost[:, 1], rightMost[:, 0])
+    tr = np.where(farther, rightMost[:, 0], rightMost[:, 1])
+
+    # return the coordinates in top-left, top-right, bottom-right,
+    # and bottom-left order
+    return np.stack([tl, tr, br, bl], axis=1).astype("float32")
+
+def get_four_point_transform(pts):
     # obtain a consistent order of the points and unpack them
     # individually
     rect = order_points(pts)
@@ -61,9 +88,30 @@ def four_point_transform(image, pts):
         [maxWidth - 1, maxHeight - 1],
         [0, maxHeight - 1]], dtype = "float32")
 
-    # compute the perspective transform matrix and then apply it
+    # compute the perspective transform matrix and return it along
+    # with the size of the warped image
     M = cv2.getPerspectiveTransform(rect, dst)
+    return M, maxWidth, maxHeight
+
+def four_point_transform(image, pts):
+    # compute the perspective transform matrix and then apply it
+    M, maxWidth, maxHeight = get_four_point_transform(pts)
     warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
 
     # return the warped image
-    return warped
\ No newline at end of file
+    return warped
+
+def four_point_transform_region(image, pts, x, y, width, height):
+    # warp only the width x height region with its top-left corner at
+    # (x, y) of the image four_point_transform would produce, by
+    # composing the perspective transform with a translation so that
+    # no pixels outside of the region are ever computed
+    M, _, _ = get_four_point_transform(pts)
+    T = np.array([
+        [1, 0, -x],
+        [0, 1, -y],
+        [0, 0, 1]], dtype = M.dtype)
+    warped = cv2.warpPerspective(image, T.dot(M), (width, height))
+
+    # return the warped region
+    return warped
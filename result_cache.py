@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Default bounds of the on-disk cache
+MAX_ENTRIES = 1000
+MAX_BYTES = 512 * 1024 * 1024
+
+META_FILE = "meta.json"
+
+
+def cache_key(content, params):
+    """
+    Returns the cache key for an upload: a SHA-256 of its bytes together with the
+    parameters of the pipeline that processed it, so a change to any of those
+    parameters never returns stale results.
+    """
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps(params, sort_keys=True).encode("utf8"))
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    """Returns the total size in bytes of the files under path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+class ResultCache(object):
+    """
+    A content-addressed, size-bounded on-disk cache of processed uploads. Each entry
+    is a directory holding copies of the result files and a JSON file with the
+    rest of the result. The least recently used entries are evicted once there are
+    more than max_entries of them or they take more than max_bytes.
+    """
+
+    def __init__(self, directory="cache", max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        """
+        Args:
+            directory (str): Where the entries are stored. Created if missing, and
+                entries already there are kept.
+            max_entries (int): Maximum number of entries. Defaults to MAX_ENTRIES.
+            max_bytes (int): Maximum total size of the entries. Defaults to MAX_BYTES.
+        """
+        self.directory = str(directory)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+        # entry sizes, least recently used first, rebuilt from what is on disk
+        self.entries = OrderedDict()
+        existing = [os.path.join(self.directory, key) for key in os.listdir(self.directory)]
+        for path in sorted(existing, key=os.path.getmtime):
+            # a .tmp directory is an entry whose put() never finished
+            if not path.endswith(".tmp") and os.path.exists(os.path.join(path, META_FILE)):
+                self.entries[os.path.basename(path)] = directory_size(path)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+        self.total_bytes = sum(self.entries.values())
+        self.evict()
+
+    def get(self, key):
+        """
+        Returns (meta, entry directory) for key, or None on a miss. The files of the
+        entry are in the entry directory under the names recorded by put(). The
+        entry can still be evicted by a later put() while they are being read, so
+        only a miss is counted here: callers count the lookup with record_hit()
+        once they know whether they could read the files.
+        """
+        path = os.path.join(self.directory, key)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            try:
+                # keep the on-disk order in step for when the cache is reloaded
+                os.utime(path)
+                with open(os.path.join(path, META_FILE)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                # the entry was removed or damaged behind the cache's back
+                self.total_bytes -= self.entries.pop(key)
+                shutil.rmtree(path, ignore_errors=True)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        return meta, path
+
+    def record_hit(self, hit):
+        """
+        Counts a lookup that get() found an entry for: as a hit if its files were
+        read, or as a miss if the entry was evicted before they could be.
+        """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key, meta, files):
+        """
+        Stores an entry for key: the JSON-serialisable meta dict, and copies of the
+        files in the {name in entry: source path} dict. Concurrent puts of the same
+        key each write their own copy, and the first one to finish is kept.
+        """
+        path = os.path.join(self.directory, key)
+        # every put stages the entry in a directory of its own, named .tmp so that
+        # one left behind by a crash is removed when the cache is next loaded
+        tmp_path = tempfile.mkdtemp(suffix=".tmp", dir=self.directory)
+        try:
+            for name, source in files.items():
+                target = os.path.join(tmp_path, name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(source, target)
+            with open(os.path.join(tmp_path, META_FILE), "w") as f:
+                json.dump(meta, f)
+            size = directory_size(tmp_path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        with self.lock:
+            if key in self.entries:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+            os.rename(tmp_path, path)
+            self.entries[key] = size
+            self.total_bytes += size
+            self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within its bounds"""
+        while self.entries and (len(self.entries) > self.max_entries
+                                or self.total_bytes > self.max_bytes):
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def stats(self):
+        """Returns the hit and miss counts and the current size of the cache"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes
+        }
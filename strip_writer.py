@@ -0,0 +1,283 @@
+import cv2
+import numpy as np
+
+import os
+import struct
+import zlib
+
+# Default compression levels, as used by cv2.imwrite
+DEFAULT_JPEG_QUALITY = 95
+DEFAULT_PNG_COMPRESSION = 1
+
+# Rows per strip of the TIFF files written by TiffStripWriter
+TIFF_ROWS_PER_STRIP = 64
+
+# Rows PngStripWriter filters at a time, which bounds its temporary arrays
+PNG_FILTER_ROWS = 32
+
+
+def to_rgb(rows):
+    """Returns BGR or BGRA rows as RGB or RGBA, leaving single channel rows as they are"""
+    if rows.ndim == 3 and rows.shape[2] == 3:
+        return rows[..., ::-1]
+    if rows.ndim == 3 and rows.shape[2] == 4:
+        return rows[..., [2, 1, 0, 3]]
+    return rows
+
+
+class StripWriter(object):
+    """
+    Base class of the writers returned by open_strip_writer(). Rows are handed to
+    write() from top to bottom in blocks of any height, and close() finishes the
+    file once all height rows have been written. abort() gives up on the file
+    after an error.
+    """
+
+    def __init__(self, path, width, height, channels):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows_written = 0
+
+    def write(self, rows):
+        """Writes the next block of rows, a (rows, width[, channels]) uint8 array"""
+        assert rows.shape[1] == self.width, "Rows do not match the image width"
+        assert self.rows_written + rows.shape[0] <= self.height, "More rows than the image height"
+        self.write_rows(rows)
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        assert self.rows_written == self.height, "Not all rows were written"
+
+    def abort(self):
+        """Gives up on the file after an error"""
+
+
+class BufferedWriter(StripWriter):
+    """
+    Gathers the rows into one image and writes it with cv2.imwrite on close, for
+    formats OpenCV cannot encode a strip at a time, such as JPEG.
+    """
+
+    def __init__(self, path, width, height, channels, params=()):
+        StripWriter.__init__(self, path, width, height, channels)
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        self.image = np.empty(shape, dtype=np.uint8)
+        self.params = list(params)
+
+    def write_rows(self, rows):
+        self.image[self.rows_written:self.rows_written + rows.shape[0]] = rows
+
+    def abort(self):
+        self.image = None
+
+    def close(self):
+        StripWriter.close(self)
+        if not cv2.imwrite(self.path, self.image, self.params):
+            raise IOError("Failed to write image: " + self.path)
+        self.image = None
+
+
+class PngStripWriter(StripWriter):
+    """
+    Writes a PNG a block of rows at a time, compressing each block as it arrives so
+    that neither the whole image nor the whole compressed stream is ever held in
+    memory. Each row is filtered with whichever of the five PNG filters gives the
+    smallest sum of absolute differences, the heuristic libpng uses.
+    """
+
+    def __init__(self, path, width, height, channels, compression=DEFAULT_PNG_COMPRESSION):
+        StripWriter.__init__(self, path, width, height, channels)
+        self.file = open(path, "wb")
+        self.compressor = zlib.compressobj(compression)
+        self.previous = np.zeros((1, width * channels), dtype=np.uint8)
+
+        color_type = {1: 0, 3: 2, 4: 6}[channels]
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+    def filter_rows(self, rows):
+        """Returns the filtered rows, each prefixed by its filter type byte"""
+        bpp = self.channels
+        raw = rows.reshape(rows.shape[0], -1)
+        up = np.concatenate([self.previous, raw[:-1]]).astype(np.int16)
+        raw16 = raw.astype(np.int16)
+        left = np.zeros_like(raw16)
+        left[:, bpp:] = raw16[:, :-bpp]
+        up_left = np.zeros_like(raw16)
+        up_left[:, bpp:] = up[:, :-bpp]
+
+        # the Paeth predictor picks whichever of left, up and up-left is closest
+        # to left + up - up-left
+        p = left + up - up_left
+        pa, pb, pc = np.abs(p - left), np.abs(p - up), np.abs(p - up_left)
+        paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+
+        candidates = np.stack([
+            raw16,
+            raw16 - left,
+            raw16 - up,
+            raw16 - (left + up) // 2,
+            raw16 - paeth]).astype(np.uint8)
+
+        # score each filter by the sum of its bytes read as signed values
+        scores = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        best = scores.argmin(axis=0)
+        filtered = candidates[best, np.arange(raw.shape[0])]
+
+        self.previous = raw[-1:]
+        return np.concatenate([best.astype(np.uint8)[:, np.newaxis], filtered], axis=1)
+
+    def write_rows(self, rows):
+        rows = to_rgb(rows)
+        for start in range(0, rows.shape[0], PNG_FILTER_ROWS):
+            data = self.compressor.compress(
+                self.filter_rows(rows[start:start + PNG_FILTER_ROWS]).tobytes())
+            if data:
+                self.write_chunk(b"IDAT", data)
+
+    def close(self):
+        StripWriter.close(self)
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class TiffStripWriter(StripWriter):
+    """
+    Writes a baseline TIFF as a sequence of strips of TIFF_ROWS_PER_STRIP rows,
+    each compressed with Deflate as it is completed, or left uncompressed if
+    compression is 0. The directory is written at the end of the file once the
+    strip offsets are known.
+    """
+
+    def __init__(self, path, width, height, channels, compression=DEFAULT_PNG_COMPRESSION,
+            rows_per_strip=TIFF_ROWS_PER_STRIP):
+        StripWriter.__init__(self, path, width, height, channels)
+        self.file = open(path, "wb")
+        self.compression = compression
+        self.rows_per_strip = rows_per_strip
+        self.pending = []
+        self.pending_rows = 0
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+
+        # little endian header, with the directory offset filled in on close
+        self.file.write(b"II*\x00\x00\x00\x00\x00")
+
+    def write_rows(self, rows):
+        self.pending.append(to_rgb(rows))
+        self.pending_rows += rows.shape[0]
+        while self.pending_rows >= self.rows_per_strip:
+            self.flush_strip(self.rows_per_strip)
+
+    def flush_strip(self, count):
+        """Writes the first count pending rows as one strip"""
+        block = np.concatenate(self.pending) if len(self.pending) > 1 else self.pending[0]
+        strip, rest = block[:count], block[count:]
+        self.pending = [rest] if len(rest) else []
+        self.pending_rows = len(rest)
+
+        data = np.ascontiguousarray(strip).tobytes()
+        if self.compression:
+            data = zlib.compress(data, self.compression)
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+
+    def write_array(self, fmt, values):
+        """Writes values at the next word boundary and returns their offset"""
+        if self.file.tell() % 2:
+            self.file.write(b"\x00")
+        offset = self.file.tell()
+        self.file.write(struct.pack("<%d%s" % (len(values), fmt), *values))
+        return offset
+
+    def close(self):
+        StripWriter.close(self)
+        if self.pending_rows:
+            self.flush_strip(self.pending_rows)
+
+        SHORT, LONG, RATIONAL = 3, 4, 5
+        strips = len(self.strip_offsets)
+        entries = [
+            (256, LONG, 1, self.width),
+            (257, LONG, 1, self.height),
+            (258, SHORT, self.channels,
+                8 if self.channels == 1 else self.write_array("H", [8] * self.channels)),
+            (259, SHORT, 1, 8 if self.compression else 1),
+            (262, SHORT, 1, 1 if self.channels == 1 else 2),
+            (273, LONG, strips,
+                self.strip_offsets[0] if strips == 1 else self.write_array("I", self.strip_offsets)),
+            (277, SHORT, 1, self.channels),
+            (278, LONG, 1, self.rows_per_strip),
+            (279, LONG, strips,
+                self.strip_byte_counts[0] if strips == 1 else self.write_array("I", self.strip_byte_counts)),
+            (282, RATIONAL, 1, self.write_array("I", [72, 1])),
+            (283, RATIONAL, 1, self.write_array("I", [72, 1])),
+            (284, SHORT, 1, 1),
+            (296, SHORT, 1, 2)]
+        if self.channels == 4:
+            # the fourth channel is unassociated alpha
+            entries.append((338, SHORT, 1, 2))
+
+        if self.file.tell() % 2:
+            self.file.write(b"\x00")
+        directory_offset = self.file.tell()
+        self.file.write(struct.pack("<H", len(entries)))
+        for tag, field_type, count, value in entries:
+            if field_type == SHORT and count == 1:
+                self.file.write(struct.pack("<HHIHH", tag, field_type, count, value, 0))
+            else:
+                self.file.write(struct.pack("<HHII", tag, field_type, count, value))
+        self.file.write(struct.pack("<I", 0))
+
+        self.file.seek(4)
+        self.file.write(struct.pack("<I", directory_offset))
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+def open_strip_writer(path, width, height, channels=3, jpeg_quality=None, png_compression=None,
+        stream=False):
+    """
+    Returns a StripWriter for a width x height image with channels channels at path,
+    in the format given by its extension. By default the rows are gathered and
+    written by cv2.imwrite on close. If stream is set, PNG and TIFF files are
+    instead encoded a block of rows at a time as they are written, which keeps
+    memory use down but is about 3x slower than cv2.imwrite. jpeg_quality (0-100)
+    and png_compression (0-9, also used as the Deflate level of TIFFs) default to
+    OpenCV's defaults, or to DEFAULT_PNG_COMPRESSION when streaming. OpenCV can't
+    set the Deflate level of a TIFF, so buffered TIFFs are left uncompressed for
+    level 0 and Deflate compressed at libtiff's default level otherwise.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if stream and ext in (".png", ".tif", ".tiff"):
+        png_compression = DEFAULT_PNG_COMPRESSION if png_compression is None else png_compression
+        if ext == ".png":
+            return PngStripWriter(path, width, height, channels, png_compression)
+        return TiffStripWriter(path, width, height, channels, png_compression)
+
+    params = []
+    if jpeg_quality is not None and ext in (".jpg", ".jpeg", ".jpe"):
+        params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+    elif png_compression is not None and ext == ".png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    elif png_compression is not None and ext in (".tif", ".tiff"):
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, cv2.IMWRITE_TIFF_COMPRESSION_ADOBE_DEFLATE
+            if png_compression else cv2.IMWRITE_TIFF_COMPRESSION_NONE]
+    return BufferedWriter(path, width, height, channels, params)
@@ -0,0 +1,194 @@
+# USAGE:
+# python synthetic.py [--output synthetic] [--count 100] [--megapixels 4] [--seed 0]
+# Renders photos of card-like documents with known corners and digits, with random
+# perspective, blur, noise, lighting and backgrounds, and writes them to the output
+# directory along with a manifest.json of the ground truth. See evaluate.py.
+
+import cv2
+import numpy as np
+
+import argparse
+import json
+import math
+import os
+
+from pipeline import DIGITS_CROP_PARAMS
+
+# Aspect ratio (width / height) of an ID-1 card and of the rendered photos
+CARD_ASPECT = 85.6 / 54.0
+PHOTO_ASPECT = 3.0 / 2.0
+
+# Fraction of the photo's width the card spans
+CARD_WIDTH_RATIO = 0.6
+
+BACKGROUNDS = ("texture", "plain", "lines")
+
+
+def photo_size(megapixels):
+    """Returns the (width, height) of a PHOTO_ASPECT photo of about megapixels"""
+    height = int(math.sqrt(megapixels * 1e6 / PHOTO_ASPECT))
+    return int(height * PHOTO_ASPECT), height
+
+
+def random_digits(rng, count=14):
+    """Returns a string of count random digits"""
+    return "".join(str(d) for d in rng.integers(0, 10, count))
+
+
+def render_card(width, digits, rng):
+    """
+    Returns a BGR image of a card width pixels wide: a light background with a
+    photo box, some lines of text and the digits string written in the region
+    pipeline.DIGITS_CROP_PARAMS crops.
+    """
+    height = int(round(width / CARD_ASPECT))
+    scale = width / 1000.0
+    card = np.full((height, width, 3), rng.integers(200, 240, 3), dtype=np.uint8)
+
+    # photo box and a few lines of "text"
+    cv2.rectangle(card, (int(40 * scale), int(40 * scale)), (int(300 * scale), int(380 * scale)),
+        [int(c) for c in rng.integers(90, 160, 3)], -1)
+    for i in range(4):
+        y = int((90 + 70 * i) * scale)
+        cv2.putText(card, "NAME SURNAME ADDRESS"[:int(rng.integers(8, 20))], (int(360 * scale), y),
+            cv2.FONT_HERSHEY_SIMPLEX, 1.1 * scale, (60, 60, 60), max(1, int(2 * scale)), cv2.LINE_AA)
+
+    # the digits, centred vertically in the digit region
+    top, bottom, left, _ = DIGITS_CROP_PARAMS
+    font_scale = 1.5 * scale
+    thickness = max(1, int(3 * scale))
+    (_, text_height), _ = cv2.getTextSize(digits, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+    y = int((top + (1 - bottom)) / 2 * height + text_height / 2)
+    x = int((left + 0.03) * width)
+    cv2.putText(card, digits, (x, y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (20, 20, 20), thickness, cv2.LINE_AA)
+    return card
+
+
+def render_background(width, height, kind, rng):
+    """
+    Returns a dark single channel background: a gradient, plus some texture for the
+    "texture" and "lines" kinds, plus a few long straight edges for "lines".
+    """
+    xs = np.linspace(0, 1, width, dtype=np.float32)
+    ys = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    background = 40 + 40 * xs + 30 * ys
+    if kind != "plain":
+        background = background + cv2.resize(
+            rng.normal(0, 12, (height // 16 + 1, width // 16 + 1)).astype(np.float32),
+            (width, height), interpolation=cv2.INTER_LINEAR)
+    background = np.clip(background, 0, 255).astype(np.uint8)
+
+    if kind == "lines":
+        # table edges and the like, which the line detector also picks up
+        for _ in range(4):
+            x0, x1 = rng.integers(0, width, 2)
+            y0, y1 = rng.integers(0, height, 2)
+            level = int(rng.integers(0, 2)) * 60 + 30
+            cv2.line(background, (int(x0), 0), (int(x1), height - 1), level, max(1, width // 300))
+            cv2.line(background, (0, int(y0)), (width - 1, int(y1)), level, max(1, width // 300))
+    return background
+
+
+def render_document(megapixels, digits=None, seed=0, perspective=0.05, blur=0.0,
+        noise=0.0, lighting=0.0, background="texture"):
+    """
+    Returns (image, corners, digits): a BGR photo of about megapixels showing a card
+    on a dark background, the (4, 2) float32 corners of the card in the photo
+    ordered top-left, top-right, bottom-right, bottom-left, and the digits written
+    on it. The same seed and settings always give the same photo.
+
+    perspective is how far each corner is moved at random, as a fraction of the
+    card's size. blur is the sigma of a Gaussian blur in pixels of a 1000 pixel
+    wide photo, noise the standard deviation of added Gaussian noise, and lighting
+    how much darker one side of the photo is than the other, from 0 to 1.
+    background is one of BACKGROUNDS.
+    """
+    rng = np.random.default_rng(seed)
+    if digits is None:
+        digits = random_digits(rng)
+    width, height = photo_size(megapixels)
+
+    background = render_background(width, height, background, rng)
+    image = cv2.merge([background, background, background])
+
+    # place the card near the middle, with each corner jittered to give some perspective
+    card = render_card(int(width * CARD_WIDTH_RATIO), digits, rng)
+    card_h, card_w = card.shape[:2]
+    source = np.float32([[0, 0], [card_w, 0], [card_w, card_h], [0, card_h]])
+    x0, y0 = (width - card_w) / 2.0, (height - card_h) / 2.0
+    corners = source + (x0, y0) + rng.uniform(-perspective, perspective, (4, 2)) * (card_w, card_h)
+    corners = corners.astype(np.float32)
+
+    M = cv2.getPerspectiveTransform(source, corners)
+    cv2.warpPerspective(card, M, (width, height), dst=image, borderMode=cv2.BORDER_TRANSPARENT)
+
+    if lighting > 0:
+        # light falling off linearly in a random direction
+        angle = rng.uniform(0, 2 * np.pi)
+        xs = np.linspace(-0.5, 0.5, width, dtype=np.float32)
+        ys = np.linspace(-0.5, 0.5, height, dtype=np.float32)[:, np.newaxis]
+        ramp = np.cos(angle) * xs + np.sin(angle) * ys
+        gain = 1 - lighting * (ramp - ramp.min()) / (ramp.max() - ramp.min())
+        image = (image * gain[:, :, np.newaxis]).astype(np.uint8)
+    if blur > 0:
+        image = cv2.GaussianBlur(image, (0, 0), blur * width / 1000.0)
+    if noise > 0:
+        image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+    return image, corners, digits
+
+
+def random_settings(rng):
+    """Returns render_document settings drawn at random from realistic ranges"""
+    return {
+        'perspective': round(float(rng.uniform(0.0, 0.12)), 3),
+        'blur': round(float(rng.choice([0.0, rng.uniform(0.5, 2.5)])), 2),
+        'noise': round(float(rng.uniform(0, 12)), 1),
+        'lighting': round(float(rng.uniform(0, 0.6)), 2),
+        'background': str(rng.choice(BACKGROUNDS))
+    }
+
+
+def generate(output_dir, count, megapixels, seed=0):
+    """
+    Renders count photos with random settings into output_dir and writes a
+    manifest.json listing each file with its corners, digits and settings.
+    Returns the path of the manifest.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    entries = []
+    for i in range(count):
+        settings = random_settings(rng)
+        image_seed = seed * 100003 + i
+        image, corners, digits = render_document(megapixels, seed=image_seed, **settings)
+        filename = f"card_{i:04d}.jpg"
+        cv2.imwrite(os.path.join(output_dir, filename), image)
+        entries.append({
+            'file': filename,
+            'corners': corners.round(2).tolist(),
+            'digits': digits,
+            'seed': image_seed,
+            'megapixels': megapixels,
+            'settings': settings
+        })
+
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump({'images': entries}, f, indent=2)
+    return manifest_path
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--output", default="synthetic",
+        help = "Directory the photos and manifest.json are written to")
+    ap.add_argument("--count", type=int, default=100,
+        help = "Number of photos to render")
+    ap.add_argument("--megapixels", type=float, default=4,
+        help = "Size of each photo, in megapixels")
+    ap.add_argument("--seed", type=int, default=0,
+        help = "Seed for the random settings and contents; the same seed gives the same set")
+    args = vars(ap.parse_args())
+
+    manifest_path = generate(args["output"], args["count"], args["megapixels"], args["seed"])
+    print(f"Rendered {args['count']} photos, manifest saved to {manifest_path}")
@@ -0,0 +1,23 @@
+import numpy as np
+
+from scan import DocScanner
+from synthetic import render_document
+from pyimagesearch import imutils, transform
+
+# Largest distance, in full resolution pixels, a refined corner may be from the
+# true corner of a synthetic card
+MAX_REFINED_ERROR = 1.5
+
+def test_refine_corners_matches_synthetic_corners():
+    scanner = DocScanner()
+    for megapixels in (2, 12):
+        for seed in range(2):
+            image, expected, _ = render_document(megapixels, seed=seed)
+            rescaled_image = imutils.resize(image, height = 500)
+            ratio = image.shape[0] / float(rescaled_image.shape[0])
+
+            corners = scanner.get_contour(rescaled_image) * ratio
+            refined = scanner.refine_corners(image, corners, ratio)
+
+            errors = np.linalg.norm(transform.order_points(refined) - expected, axis=1)
+            assert errors.max() < MAX_REFINED_ERROR, (megapixels, seed, errors)